@@ -0,0 +1,186 @@
+# Benchmark ngoại tuyến: chạy vòng gửi 'kd' và xử lý drop của bot với máy chủ Discord giả (fake_discord.py).
+# Ví dụ: python benchmark.py --sizes 10 1000 10000 --latency 0.03 --rate-429 0.01 --output bench_output.txt
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from metrics import SampleWindow
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark vòng gửi 'kd' và xử lý drop với Discord giả lập")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000], help="số panel giả cho mỗi lượt chạy")
+    parser.add_argument("--drops", type=int, default=200, help="số tin nhắn drop giả mỗi lượt chạy")
+    parser.add_argument("--drop-window", type=float, default=5.0, help="rải các drop trong bao nhiêu giây")
+    parser.add_argument("--noise", type=float, default=0.5, help="xác suất chèn tin nhắn không liên quan trước mỗi drop")
+    parser.add_argument("--latency", type=float, default=0.03, help="độ trễ của REST giả (giây)")
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="xác suất REST giả trả 429")
+    parser.add_argument("--port", type=int, default=0, help="cổng cho REST giả (0 = tự chọn)")
+    parser.add_argument("--output", help="ghi kết quả dạng JSON vào file này")
+    return parser.parse_args()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_fake_server(args, port):
+    """Chạy fake_discord.py ở tiến trình riêng để không tranh CPU với bot."""
+    proc = subprocess.Popen([
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_discord.py"),
+        "--port", str(port), "--latency", str(args.latency), "--jitter", str(args.jitter),
+        "--rate-429", str(args.rate_429), "--bucket-limit", "1000000",
+    ])
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        with contextlib.suppress(OSError), socket.create_connection(("127.0.0.1", port), timeout=0.2):
+            return proc
+        time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("Không khởi động được máy chủ Discord giả.")
+
+
+def rss_mb():
+    """RSS hiện tại (MB). Đọc /proc nếu có, nếu không dùng đỉnh RSS từ getrusage."""
+    with contextlib.suppress(OSError):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_panels(count):
+    panels = []
+    for i in range(count):
+        channel_id = str(100000000000000000 + i)
+        panels.append({
+            "id": f"bench_{i}",
+            "name": f"Bench {i}",
+            "channel_id": channel_id,
+            "server_name": "",
+            "accounts": {f"slot_{s}": f"bench-token-{i}-{s}" for s in range(1, 4)},
+        })
+    return panels
+
+
+async def run_size(bot, fake_gateway_cls, size, args):
+    panels = make_panels(size)
+    bot.kd_wheel.assign_offsets(panels)
+    bot.publish_panels(panels)
+    bot.drop_latency = bot.LatencyTracker()
+
+    peak_threads = threading.active_count()
+    sampling = True
+
+    async def sample_threads():
+        nonlocal peak_threads
+        while sampling:
+            peak_threads = max(peak_threads, threading.active_count())
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.create_task(sample_threads())
+    rss_before = rss_mb()
+
+    # 1. Trường hợp xấu nhất: mọi panel cùng gửi 'kd' một lúc
+    send_latency = SampleWindow(size)
+    original_send = bot.send_message_http
+
+    async def timed_send(*a, **kw):
+        started = time.perf_counter()
+        await original_send(*a, **kw)
+        send_latency.add(time.perf_counter() - started)
+
+    bot.send_message_http = timed_send
+    started = time.perf_counter()
+    sent = await bot.fire_panels(bot.kd_wheel.plan, range(len(panels)))
+    cycle_seconds = time.perf_counter() - started
+    bot.send_message_http = original_send
+
+    # 2. Drop giả đi qua on_drop_message -> handle_reactions
+    gateway = fake_gateway_cls([p["channel_id"] for p in panels], noise_ratio=args.noise)
+    before = asyncio.all_tasks()
+    started = time.perf_counter()
+    await gateway.run(bot.on_drop_message, args.drops, args.drop_window)
+    pending = asyncio.all_tasks() - before - {asyncio.current_task(), sampler}
+    await asyncio.gather(*pending)
+    drop_seconds = time.perf_counter() - started
+
+    sampling = False
+    await sampler
+    return {
+        "panels": size,
+        "kd_cycle": {
+            "sends": sent,
+            "seconds": round(cycle_seconds, 4),
+            "throughput_per_s": round(sent / cycle_seconds, 1) if cycle_seconds else None,
+            "latency": send_latency.summary(),
+        },
+        "drops": {
+            "count": args.drops,
+            "seconds": round(drop_seconds, 4),
+            "stages": bot.drop_latency.summary(),
+        },
+        "wheel_peak_per_tick": max(len(b) for b in bot.kd_wheel.buckets),
+        "threads_peak": peak_threads,
+        "rss_mb_before": round(rss_before, 1),
+        "rss_mb_after": round(rss_mb(), 1),
+    }
+
+
+def print_result(result, out):
+    cycle = result["kd_cycle"]
+    lat = cycle["latency"]
+    e2e = result["drops"]["stages"].get("end_to_end", {})
+    overshoot = result["drops"]["stages"].get("sleep_overshoot", {})
+    print(f"--- {result['panels']} panel ---", file=out)
+    print(f"  kd: {cycle['sends']} lệnh trong {cycle['seconds']}s ({cycle['throughput_per_s']}/s), "
+          f"p50={lat.get('p50', 0):.4f}s p99={lat.get('p99', 0):.4f}s", file=out)
+    print(f"  drop: {result['drops']['count']} drop, end_to_end p50={e2e.get('p50', 0):.4f}s p99={e2e.get('p99', 0):.4f}s, "
+          f"ngủ trễ p99={overshoot.get('p99', 0):.4f}s", file=out)
+    print(f"  bánh xe hẹn giờ: tối đa {result['wheel_peak_per_tick']} panel mỗi nhịp", file=out)
+    print(f"  luồng tối đa: {result['threads_peak']}, RSS: {result['rss_mb_before']} -> {result['rss_mb_after']} MB", file=out)
+
+
+async def run(args):
+    # Phải đặt biến môi trường trước khi import bot để client HTTP trỏ vào máy chủ giả
+    port = args.port or free_port()
+    os.environ["DISCORD_API_BASE"] = f"http://127.0.0.1:{port}"
+    os.environ.setdefault("HTTP_POOL_LIMIT", "200")
+    import multi_kd_v2 as bot
+    from fake_discord import FakeGateway
+
+    proc = start_fake_server(args, port)
+    results = []
+    real_stdout = sys.stdout
+    try:
+        for size in args.sizes:
+            # Bỏ log của bot để chỉ đo phần việc chính
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                result = await run_size(bot, FakeGateway, size, args)
+            results.append(result)
+            print_result(result, real_stdout)
+    finally:
+        await bot.close_session()
+        proc.terminate()
+        proc.wait()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2, ensure_ascii=False)
+        print(f"Đã ghi kết quả vào {args.output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
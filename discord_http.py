@@ -0,0 +1,169 @@
+# Client HTTP dùng chung cho mọi lời gọi REST tới Discord.
+# Một aiohttp.ClientSession duy nhất sống trên event loop chính, giữ kết nối keep-alive
+# để mỗi lệnh 'kd' / reaction không phải bắt tay TCP+TLS lại từ đầu.
+import os
+import time
+import asyncio
+import logging
+import aiohttp
+from dotenv import load_dotenv
+from metrics import REGISTRY
+
+load_dotenv()
+log = logging.getLogger(__name__)
+
+DISCORD_API = os.getenv("DISCORD_API_BASE", "https://discord.com/api/v9").rstrip("/")
+
+# Giới hạn số kết nối đồng thời của pool (tổng và theo từng host)
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "200"))
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=10)
+# Số lần thử lại tối đa khi vẫn bị Discord trả về 429
+RATELIMIT_MAX_RETRIES = int(os.getenv("RATELIMIT_MAX_RETRIES", "3"))
+
+_session = None
+
+REST_LATENCY = REGISTRY.histogram(
+    "discord_rest_latency_seconds", "Thời gian một request REST tới Discord (không tính thời gian chờ rate limit).",
+    ["method", "route", "status"])
+RATELIMIT_HITS = REGISTRY.counter(
+    "discord_ratelimit_hits_total", "Số lần Discord trả về 429.", ["method", "route", "scope"])
+
+
+def get_session():
+    """Trả về session dùng chung, tạo mới nếu chưa có. Phải gọi từ trong event loop."""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT,
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=HTTP_TIMEOUT)
+    return _session
+
+
+async def close_session():
+    """Đóng session dùng chung khi tắt chương trình."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+# --- RATE LIMIT ---
+class _Bucket:
+    """Trạng thái một bucket rate limit: số request còn lại và thời điểm reset (theo loop.time())."""
+    __slots__ = ("remaining", "reset_at", "lock")
+
+    def __init__(self):
+        self.remaining = None # Chưa biết cho tới khi nhận header đầu tiên
+        self.reset_at = 0.0
+        self.lock = asyncio.Lock()
+
+
+class RateLimiter:
+    """Điều phối request theo header X-RateLimit-* / Retry-After, tách bucket theo token và route."""
+
+    def __init__(self, max_retries=RATELIMIT_MAX_RETRIES):
+        self.max_retries = max_retries
+        self._route_hashes = {} # (method, route) -> X-RateLimit-Bucket do Discord trả về
+        self._buckets = {}      # (token, bucket, major) -> _Bucket
+        self._global_until = {} # token -> thời điểm hết global rate limit
+
+    def _bucket_for(self, token, method, route, major):
+        bucket_id = self._route_hashes.get((method, route), f"{method} {route}")
+        key = (token, bucket_id, major)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket()
+        return bucket
+
+    async def _acquire(self, token, bucket):
+        """Chờ tới khi bucket còn lượt. Trả về True nếu vẫn đang giữ lock (bucket chưa biết giới hạn)."""
+        loop = asyncio.get_running_loop()
+        global_wait = self._global_until.get(token, 0.0) - loop.time()
+        if global_wait > 0:
+            await asyncio.sleep(global_wait)
+        # Giữ lock trong lúc chờ reset để các request cùng bucket xếp hàng thay vì cùng lúc ăn 429
+        await bucket.lock.acquire()
+        now = loop.time()
+        if bucket.remaining == 0:
+            try:
+                if bucket.reset_at > now:
+                    await asyncio.sleep(bucket.reset_at - now)
+            except BaseException:
+                # Bị hủy khi đang chờ reset: phải trả lock, nếu không bucket này kẹt vĩnh viễn
+                bucket.lock.release()
+                raise
+            bucket.remaining = None
+        if bucket.remaining is None:
+            # Chưa biết giới hạn: cho đúng một request đi trước để đọc header
+            return True
+        bucket.remaining -= 1
+        bucket.lock.release()
+        return False
+
+    def _update(self, token, method, route, major, bucket, headers):
+        loop = asyncio.get_running_loop()
+        bucket_hash = headers.get("X-RateLimit-Bucket")
+        if bucket_hash and self._route_hashes.get((method, route)) != bucket_hash:
+            self._route_hashes[(method, route)] = bucket_hash
+            self._buckets[(token, bucket_hash, major)] = bucket
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset_after = headers.get("X-RateLimit-Reset-After")
+        if remaining is not None:
+            bucket.remaining = int(remaining)
+        if reset_after is not None:
+            bucket.reset_at = loop.time() + float(reset_after)
+
+    async def request(self, method, route, token, *, json=None, **params):
+        """Gửi request tới route (vd '/channels/{channel_id}/messages'), tự chờ khi hết lượt.
+
+        Trả về (status, data) với data là JSON nếu có, ngược lại là text.
+        """
+        path = route.format(**params)
+        major = params.get("channel_id") or params.get("guild_id") or ""
+        headers = {"Authorization": token}
+        loop = asyncio.get_running_loop()
+
+        for attempt in range(self.max_retries + 1):
+            bucket = self._bucket_for(token, method, route, major)
+            holding = await self._acquire(token, bucket)
+            started = time.perf_counter()
+            try:
+                async with get_session().request(method, DISCORD_API + path, headers=headers, json=json) as res:
+                    self._update(token, method, route, major, bucket, res.headers)
+                    if res.content_type == "application/json":
+                        data = await res.json()
+                    else:
+                        data = await res.text()
+            finally:
+                if holding:
+                    bucket.lock.release()
+            REST_LATENCY.observe(time.perf_counter() - started, method=method, route=route, status=res.status)
+            if res.status != 429:
+                return res.status, data
+
+            body = data if isinstance(data, dict) else {}
+            retry_after = float(body.get("retry_after") or res.headers.get("Retry-After") or 1)
+            is_global = bool(body.get("global") or res.headers.get("X-RateLimit-Global"))
+            RATELIMIT_HITS.inc(method=method, route=route, scope="global" if is_global else "bucket")
+            # Ghi nhận thời gian chờ cả ở lần thử cuối để các request sau không lao thẳng vào 429 nữa
+            if is_global:
+                self._global_until[token] = loop.time() + retry_after
+            else:
+                bucket.remaining = 0
+                bucket.reset_at = loop.time() + retry_after
+            if attempt == self.max_retries:
+                return res.status, data
+            log.warning("[RATE LIMIT] %s %s bị 429, thử lại sau %.2fs (lần %d/%d).", method, path, retry_after,
+                        attempt + 1, self.max_retries, extra={"status": 429, "latency": retry_after})
+
+
+rate_limiter = RateLimiter()
+
+
+async def discord_request(method, route, token, **kwargs):
+    """Gọi REST Discord qua session dùng chung và bộ điều phối rate limit."""
+    return await rate_limiter.request(method, route, token, **kwargs)
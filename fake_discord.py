@@ -0,0 +1,146 @@
+# Máy chủ giả lập Discord REST + nguồn sự kiện gateway giả, dùng cho benchmark và thử nghiệm cục bộ.
+# Chạy riêng: python fake_discord.py --port 8790 --latency 0.05 --jitter 0.02 --rate-429 0.01
+# Sau đó trỏ bot vào bằng DISCORD_API_BASE=http://127.0.0.1:8790
+import argparse
+import asyncio
+import random
+import time
+from types import SimpleNamespace
+from aiohttp import web
+
+KARUTA_ID = 646937666251915264
+DISCORD_EPOCH = 1420070400000
+
+
+def make_snowflake(at=None):
+    """Tạo snowflake ID tương ứng với thời điểm at (epoch giây)."""
+    ms = int((time.time() if at is None else at) * 1000) - DISCORD_EPOCH
+    return (ms << 22) | random.getrandbits(22)
+
+
+class FakeDiscordAPI:
+    """Các route REST mà bot dùng, có độ trễ cấu hình được, giới hạn theo bucket và chèn 429 ngẫu nhiên."""
+
+    def __init__(self, latency=0.0, jitter=0.0, rate_429=0.0, retry_after=0.5,
+                 bucket_limit=50, bucket_window=1.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.bucket_limit = bucket_limit
+        self.bucket_window = bucket_window
+        self._windows = {} # (token, method, channel) -> [bắt đầu cửa sổ, số request]
+        self.stats = {"requests": 0, "rate_limited": 0, "injected_429": 0}
+
+    async def _delay(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _limit(self, request, bucket):
+        """Trả về response 429 nếu vượt giới hạn, nếu không thì trả về header rate limit."""
+        self.stats["requests"] += 1
+        key = (request.headers.get("Authorization", ""), request.method, request.match_info.get("channel_id", ""))
+        now = time.monotonic()
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= self.bucket_window:
+            window = self._windows[key] = [now, 0]
+        window[1] += 1
+        reset_after = max(0.0, self.bucket_window - (now - window[0]))
+        headers = {
+            "X-RateLimit-Bucket": bucket,
+            "X-RateLimit-Limit": str(self.bucket_limit),
+            "X-RateLimit-Remaining": str(max(0, self.bucket_limit - window[1])),
+            "X-RateLimit-Reset-After": f"{reset_after:.3f}",
+        }
+        if window[1] > self.bucket_limit:
+            self.stats["rate_limited"] += 1
+            return web.json_response({"message": "You are being rate limited.", "retry_after": reset_after, "global": False},
+                                     status=429, headers=headers), None
+        if self.rate_429 and random.random() < self.rate_429:
+            self.stats["injected_429"] += 1
+            return web.json_response({"message": "You are being rate limited.", "retry_after": self.retry_after, "global": False},
+                                     status=429, headers={**headers, "Retry-After": str(self.retry_after)}), None
+        return None, headers
+
+    async def send_message(self, request):
+        await self._delay()
+        error, headers = self._limit(request, "messages")
+        if error is not None:
+            return error
+        return web.json_response({"id": str(make_snowflake()), "channel_id": request.match_info["channel_id"]},
+                                 headers=headers)
+
+    async def add_reaction(self, request):
+        await self._delay()
+        error, headers = self._limit(request, "reactions")
+        if error is not None:
+            return error
+        return web.Response(status=204, headers=headers)
+
+    async def get_channel(self, request):
+        await self._delay()
+        channel_id = request.match_info["channel_id"]
+        return web.json_response({"id": channel_id, "guild_id": str(int(channel_id) % 100 + 1)})
+
+    async def get_guild(self, request):
+        await self._delay()
+        guild_id = request.match_info["guild_id"]
+        return web.json_response({"id": guild_id, "name": f"Fake Guild {guild_id}"})
+
+    async def get_stats(self, request):
+        return web.json_response(self.stats)
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post("/channels/{channel_id}/messages", self.send_message)
+        app.router.add_put("/channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me", self.add_reaction)
+        app.router.add_get("/channels/{channel_id}", self.get_channel)
+        app.router.add_get("/guilds/{guild_id}", self.get_guild)
+        app.router.add_get("/_stats", self.get_stats)
+        return app
+
+
+class FakeGateway:
+    """Nguồn sự kiện gateway giả: sinh tin nhắn drop của Karuta (và tin nhắn nhiễu) vào các kênh cho trước."""
+
+    def __init__(self, channel_ids, noise_ratio=0.0):
+        self.channel_ids = list(channel_ids)
+        self.noise_ratio = noise_ratio
+
+    def make_message(self, channel_id, drop=True):
+        author_id = KARUTA_ID if drop else random.getrandbits(60)
+        content = "@user is dropping 3 cards!" if drop else "hello"
+        return SimpleNamespace(id=make_snowflake(), content=content,
+                               author=SimpleNamespace(id=author_id),
+                               channel=SimpleNamespace(id=int(channel_id)))
+
+    async def run(self, handler, count, duration):
+        """Gọi handler(message) cho count tin nhắn drop, rải đều trong duration giây."""
+        interval = duration / count if count else 0
+        for _ in range(count):
+            while self.noise_ratio and random.random() < self.noise_ratio:
+                await handler(self.make_message(random.choice(self.channel_ids), drop=False))
+            await handler(self.make_message(random.choice(self.channel_ids)))
+            if interval:
+                await asyncio.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Máy chủ Discord REST giả lập")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--latency", type=float, default=0.0, help="độ trễ cố định mỗi request (giây)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="độ trễ ngẫu nhiên thêm vào (giây)")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="xác suất trả 429 ngẫu nhiên")
+    parser.add_argument("--retry-after", type=float, default=0.5)
+    parser.add_argument("--bucket-limit", type=int, default=50)
+    parser.add_argument("--bucket-window", type=float, default=1.0)
+    args = parser.parse_args()
+    api = FakeDiscordAPI(args.latency, args.jitter, args.rate_429, args.retry_after,
+                         args.bucket_limit, args.bucket_window)
+    web.run_app(api.make_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
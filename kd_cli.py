@@ -0,0 +1,86 @@
+# Công cụ dòng lệnh sao lưu / chuyển / so sánh cấu hình panel qua API NDJSON của dashboard.
+# Ví dụ: python kd_cli.py export -o panels.ndjson
+#        python kd_cli.py import panels.ndjson --dry-run
+#        python kd_cli.py import panels.ndjson --replace --url http://127.0.0.1:10000
+import argparse
+import json
+import os
+import sys
+
+import requests
+
+CHUNK_BYTES = 64 * 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Xuất / nhập cấu hình panel dạng NDJSON")
+    parser.add_argument("--url", default=os.getenv("KD_URL", f"http://127.0.0.1:{os.getenv('PORT', '10000')}"),
+                        help="địa chỉ dashboard (mặc định lấy từ KD_URL)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    export = sub.add_parser("export", help="tải cấu hình về (mỗi dòng một panel)")
+    export.add_argument("-o", "--output", help="ghi vào file này thay vì stdout")
+    export.add_argument("--tokens", action="store_true", help="xuất cả token thay cho id tài khoản")
+
+    imp = sub.add_parser("import", help="nạp cấu hình từ file NDJSON ('-' là stdin)")
+    imp.add_argument("file")
+    imp.add_argument("--replace", action="store_true", help="xóa các panel không có trong file")
+    imp.add_argument("--dry-run", action="store_true", help="chỉ kiểm tra, không áp dụng")
+    return parser.parse_args()
+
+
+def export_panels(args):
+    """Stream NDJSON từ server ra file theo từng khối, không giữ cả cấu hình trong bộ nhớ."""
+    params = {"tokens": "1"} if args.tokens else {}
+    with requests.get(f"{args.url}/api/panels/export", params=params, stream=True, timeout=30) as res:
+        res.raise_for_status()
+        out = open(args.output, "wb") if args.output else sys.stdout.buffer
+        try:
+            for chunk in res.iter_content(CHUNK_BYTES):
+                out.write(chunk)
+        finally:
+            if args.output:
+                out.close()
+        print(f"Đã xuất cấu hình version {res.headers.get('X-Config-Version')}.", file=sys.stderr)
+
+
+def read_chunks(f):
+    while True:
+        chunk = f.read(CHUNK_BYTES)
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_panels(args):
+    """Gửi file lên theo từng khối (chunked transfer) và in kết quả server trả về."""
+    params = {}
+    if args.replace:
+        params["mode"] = "replace"
+    if args.dry_run:
+        params["dry_run"] = "1"
+    f = sys.stdin.buffer if args.file == "-" else open(args.file, "rb")
+    try:
+        res = requests.post(f"{args.url}/api/panels/import", params=params, data=read_chunks(f),
+                            headers={"Content-Type": "application/x-ndjson"}, timeout=300)
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+    print(json.dumps(res.json(), ensure_ascii=False, indent=2))
+    return 0 if res.ok and not res.json().get("errors") else 1
+
+
+def main():
+    args = parse_args()
+    try:
+        if args.command == "export":
+            export_panels(args)
+            return 0
+        return import_panels(args)
+    except requests.RequestException as e:
+        print(f"Lỗi khi gọi {args.url}: {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
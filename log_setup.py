@@ -0,0 +1,102 @@
+# Ghi log không chặn: các nơi gọi log chỉ đẩy bản ghi vào hàng đợi, một luồng nền (QueueListener)
+# mới định dạng và ghi ra console + file JSON lines có xoay vòng theo dung lượng.
+# Trường có cấu trúc truyền qua extra, vd: log.info("Đã gửi 'kd'", extra={"channel": cid, "status": 200, "latency": 0.12})
+import os
+import sys
+import json
+import atexit
+import queue
+import logging
+import logging.handlers
+
+# Các trường có cấu trúc được đưa vào log JSON nếu bản ghi có
+STRUCTURED_FIELDS = ("panel", "slot", "channel", "guild", "account", "message_id", "status", "latency", "count", "error")
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Mỗi bản ghi là một dòng JSON: thời điểm, mức, logger, nội dung và các trường có cấu trúc."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key in STRUCTURED_FIELDS:
+            value = record.__dict__.get(key)
+            if value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Định dạng dễ đọc cho console: nội dung kèm các trường có cấu trúc dạng key=value."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s [%(name)s] %(message)s", "%H:%M:%S")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = " ".join(f"{k}={record.__dict__[k]}" for k in STRUCTURED_FIELDS if record.__dict__.get(k) is not None)
+        return f"{line} {fields}" if fields else line
+
+
+class _FastQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler chỉ ghép chuỗi nội dung rồi đẩy vào hàng đợi, việc định dạng để luồng nền làm."""
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(log_file=None):
+    """Gắn hàng đợi log vào root logger (chỉ một lần). Cấu hình qua LOG_LEVEL, LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT.
+
+    log_file ghi đè LOG_FILE, dùng khi nhiều tiến trình cần file log riêng (xoay vòng không an toàn khi dùng chung).
+    """
+    global _listener
+    if _listener is not None:
+        return
+    level = getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO)
+
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(TextFormatter())
+    handlers = [console]
+    if log_file is None:
+        log_file = os.getenv("LOG_FILE", "kd.log")
+    if log_file:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024)),
+            backupCount=int(os.getenv("LOG_BACKUP_COUNT", "5")), encoding="utf-8")
+        file_handler.setFormatter(JsonFormatter())
+        handlers.append(file_handler)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_FastQueueHandler(log_queue))
+    # discord.py ghi rất nhiều log DEBUG/INFO về gateway, chỉ giữ cảnh báo trở lên
+    logging.getLogger("discord").setLevel(max(level, logging.WARNING))
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Ghi nốt các bản ghi còn trong hàng đợi rồi dừng luồng nền."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,73 @@
+# Theo dõi độ trễ của event loop asyncio: một coroutine ngủ đều đặn và đo mình bị đánh thức trễ bao lâu,
+# một luồng canh (watchdog) phát hiện khi loop bị chặn quá lâu và ghi lại stack của luồng chạy loop
+# để biết lời gọi nào đang chặn (vd I/O đồng bộ lọt vào handler).
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+
+from metrics import REGISTRY, SampleWindow
+
+log = logging.getLogger(__name__)
+
+LOOP_LAG = REGISTRY.histogram(
+    "event_loop_lag_seconds", "Độ trễ đánh thức của event loop so với lịch.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+LOOP_STALLS = REGISTRY.counter("event_loop_stalls_total", "Số lần event loop bị chặn lâu hơn ngưỡng watchdog.")
+
+
+class LoopMonitor:
+    """Lấy mẫu độ trễ của loop mỗi interval giây; watchdog ghi stack khi loop không phản hồi quá stall_after giây."""
+
+    def __init__(self, interval=0.25, stall_after=1.0, window=2400):
+        self.interval = interval
+        self.stall_after = stall_after
+        self.lag = SampleWindow(window)
+        self.last_beat = None # time.monotonic() lần cuối loop chạy tới nhịp lấy mẫu
+        self.stalls = 0
+        self._thread_id = None
+        self._stop = threading.Event()
+
+    async def run(self):
+        """Coroutine lấy mẫu, chạy trên chính loop cần theo dõi. Tự khởi động luồng watchdog."""
+        loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        watchdog.start()
+        try:
+            while True:
+                started = loop.time()
+                await asyncio.sleep(self.interval)
+                lag = max(0.0, loop.time() - started - self.interval)
+                self.last_beat = time.monotonic()
+                self.lag.add(lag)
+                LOOP_LAG.observe(lag)
+        finally:
+            self._stop.set()
+
+    def stalled_for(self):
+        """Số giây kể từ nhịp cuối, trừ đi một chu kỳ lấy mẫu bình thường (0 nếu loop vẫn chạy đều)."""
+        if self.last_beat is None:
+            return 0.0
+        return max(0.0, time.monotonic() - self.last_beat - self.interval)
+
+    def _watch(self):
+        reported = None # last_beat của lần chặn đã ghi log, mỗi lần chặn chỉ ghi một lần
+        while not self._stop.wait(self.interval):
+            beat = self.last_beat
+            stalled = self.stalled_for()
+            if stalled < self.stall_after or beat == reported:
+                continue
+            reported = beat
+            self.stalls += 1
+            LOOP_STALLS.inc()
+            frame = sys._current_frames().get(self._thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "(không lấy được stack)"
+            log.warning("[LOOP] Event loop bị chặn %.2fs, stack hiện tại:\n%s", stalled, stack,
+                        extra={"latency": round(stalled, 3)})
+
+    def summary(self):
+        return {**self.lag.summary(), "stalled_for": round(self.stalled_for(), 3), "stalls": self.stalls}
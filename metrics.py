@@ -0,0 +1,226 @@
+# Bộ đếm / histogram tối giản xuất theo định dạng text của Prometheus cho endpoint /metrics,
+# cùng cửa sổ mẫu để tính phân vị độ trễ cho các API theo dõi.
+# Không cần thư viện prometheus_client; mọi thao tác đều an toàn đa luồng.
+import math
+import threading
+from collections import deque
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Bộ đếm chỉ tăng. collect() (nếu có) trả về {tuple giá trị nhãn: giá trị} cộng thêm lúc scrape,
+    vd số đếm từ các tiến trình khác."""
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+        self._collect = collect
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def snapshot(self):
+        """{tuple giá trị nhãn: giá trị} của mọi chuỗi hiện có."""
+        with self._lock:
+            return dict(self._values)
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        if self._collect is not None:
+            for key, value in self._collect().items():
+                values[key] = values.get(key, 0) + value
+        items = sorted(values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """Giá trị tức thời. Có thể truyền hàm collect() trả về {nhãn: giá trị} để tính lúc scrape."""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+        self._collect = collect
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def _samples(self):
+        if self._collect is not None:
+            # collect() trả về {giá trị nhãn (hoặc tuple nếu nhiều nhãn): giá trị}
+            items = sorted(((k if isinstance(k, tuple) else (k,)), v) for k, v in self._collect().items())
+        else:
+            with self._lock:
+                items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    """Histogram với các bucket cố định (đơn vị giây)."""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._series = {} # nhãn -> [số đếm theo bucket, tổng, số mẫu]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self._series.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                le = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+def process_rss_bytes():
+    """RSS hiện tại của tiến trình (byte), đọc từ /proc/self/status. Trả về None nếu không có /proc."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class Registry:
+    """Tập hợp các metric, xuất ra một trang text cho /metrics."""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class SampleWindow:
+    """Giữ N mẫu gần nhất để tính phân vị (p50/p90/p99) chính xác trên cửa sổ trượt."""
+
+    def __init__(self, size=2048):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, value):
+        with self._lock:
+            self._samples.append(value)
+
+    def summary(self, percentiles=(50, 90, 99)):
+        with self._lock:
+            data = sorted(self._samples)
+        if not data:
+            return {"count": 0}
+        result = {"count": len(data), "max": data[-1]}
+        for p in percentiles:
+            # Phân vị theo nearest-rank
+            rank = max(1, math.ceil(p / 100 * len(data)))
+            result[f"p{p}"] = data[rank - 1]
+        return result
+
+
+class LatencyTracker:
+    """Cửa sổ mẫu độ trễ theo từng giai đoạn (stage)."""
+
+    def __init__(self, window=2048):
+        self.window = window
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            samples = self._stages.get(stage)
+            if samples is None:
+                samples = self._stages[stage] = SampleWindow(self.window)
+        samples.add(seconds)
+
+    def summary(self):
+        with self._lock:
+            stages = dict(self._stages)
+        return {stage: samples.summary() for stage, samples in sorted(stages.items())}
@@ -6,13 +6,34 @@ import asyncio
 import os
 import threading
 import time
-import requests
 import json
+import gzip
+import base64
+import bisect
+import hashlib
+import logging
+import queue
 import random
-from flask import Flask, request, render_template_string, jsonify
+import zlib
+import multiprocessing
+from collections import deque
+from types import SimpleNamespace
+from urllib.parse import quote
+import aiohttp
+from flask import Flask, Response, request, jsonify, send_from_directory
 from dotenv import load_dotenv
+from discord_http import discord_request, close_session
+from panel_store import create_panel_store, DebouncedWriter, SQLitePanelStore
+from metrics import REGISTRY, LatencyTracker, process_rss_bytes
+from log_setup import setup_logging
+from loop_health import LoopMonitor
+try:
+    import brotli
+except ImportError:
+    brotli = None # Không có brotli thì chỉ nén gzip
 
 load_dotenv()
+log = logging.getLogger("multi_kd")
 
 # --- CẤU HÌNH & BIẾN TOÀN CỤC ---
 KARUTA_ID = 646937666251915264
@@ -30,169 +51,672 @@ for i, token in enumerate(tokens_list):
     name = acc_names_list[i] if i < len(acc_names_list) else f"Account {i + 1}"
     GLOBAL_ACCOUNTS.append({"id": f"acc_{i}", "name": name, "token": token})
 
-# Biến trạng thái, sẽ được load từ JSONBin
-panels = []
-current_drop_slot = 0 # Slot đang trong lượt drop (0-2)
+# Ánh xạ token <-> id tài khoản để dashboard chỉ cần biết id, không thấy token
+ACCOUNT_ID_BY_TOKEN = {acc["token"]: acc["id"] for acc in GLOBAL_ACCOUNTS}
+TOKEN_BY_ACCOUNT_ID = {acc["id"]: acc["token"] for acc in GLOBAL_ACCOUNTS}
+
+# Biến trạng thái, sẽ được load từ nơi lưu trữ
+class PanelSnapshot:
+    """Bản chụp bất biến của cấu hình panel cùng các chỉ mục dẫn xuất.
+
+    Không sửa tại chỗ bản chụp hay các panel bên trong: người ghi tạo panel mới rồi đăng bản chụp mới,
+    người đọc chỉ cần đọc biến panel_state một lần là có bộ dữ liệu nhất quán mà không cần lock.
+    """
+    __slots__ = ("version", "panels", "by_id", "by_channel", "watched_channel_ids", "_index")
+
+    def __init__(self, panels, version=0):
+        self.version = version
+        self.panels = tuple(panels)
+        self.by_id = {p.get("id"): p for p in self.panels}
+        by_channel = {}
+        for p in self.panels:
+            channel_id = p.get("channel_id")
+            if channel_id:
+                by_channel.setdefault(channel_id, p) # Giữ panel đầu tiên như cách tìm tuyến tính cũ
+        self.by_channel = by_channel
+        # Channel ID (int) có panel, để bot lắng nghe bỏ qua sớm các kênh khác
+        self.watched_channel_ids = frozenset(int(cid) for cid in by_channel if cid.isdigit())
+        self._index = None
+
+    def index(self):
+        """Chỉ mục tra cứu cho API danh sách panel, chỉ dựng khi có truy vấn đầu tiên trên bản chụp này."""
+        if self._index is None:
+            self._index = PanelIndex(self.panels)
+        return self._index
+
+class PanelIndex:
+    """Chỉ mục ngược theo vị trí panel trong bản chụp: trigram tên, kênh, server, tài khoản, slot trống.
+
+    Mỗi danh sách vị trí đã sắp xếp tăng dần, nên lọc là phép giao tập và phân trang là bisect.
+    """
+
+    def __init__(self, panels):
+        self.positions = {p.get("id"): i for i, p in enumerate(panels)}
+        self.names = [str(p.get("name", "")).casefold() for p in panels]
+        self.trigrams = {}
+        self.by_channel = {}
+        self.by_guild = {}
+        self.by_account = {}
+        self.unassigned = {slot_key: [] for slot_key in SLOT_KEYS}
+        for i, p in enumerate(panels):
+            for gram in {self.names[i][j:j + 3] for j in range(len(self.names[i]) - 2)}:
+                self.trigrams.setdefault(gram, []).append(i)
+            if p.get("channel_id"):
+                self.by_channel.setdefault(p["channel_id"], []).append(i)
+            if p.get("guild_id"):
+                self.by_guild.setdefault(p["guild_id"], []).append(i)
+            accounts = p.get("accounts", {})
+            for account_id in {ACCOUNT_ID_BY_TOKEN.get(t) for t in accounts.values() if t} - {None}:
+                self.by_account.setdefault(account_id, []).append(i)
+            for slot_key in SLOT_KEYS:
+                if not accounts.get(slot_key):
+                    self.unassigned[slot_key].append(i)
+
+    def match_name(self, text):
+        """Vị trí các panel có tên chứa text (không phân biệt hoa thường)."""
+        text = text.casefold()
+        if len(text) < 3:
+            # Chuỗi quá ngắn để dùng trigram, quét danh sách tên đã chuẩn hóa
+            return [i for i, name in enumerate(self.names) if text in name]
+        postings = sorted((self.trigrams.get(text[j:j + 3], []) for j in range(len(text) - 2)), key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return sorted(i for i in candidates if text in self.names[i])
+
+    def query(self, name=None, channel_id=None, guild_id=None, account=None, unassigned=None):
+        """Danh sách vị trí (tăng dần) khớp mọi bộ lọc được truyền; None nếu không có bộ lọc nào."""
+        lists = []
+        if name:
+            lists.append(self.match_name(name))
+        if channel_id:
+            lists.append(self.by_channel.get(channel_id, []))
+        if guild_id:
+            lists.append(self.by_guild.get(guild_id, []))
+        if account:
+            lists.append(self.by_account.get(account, []))
+        if unassigned and unassigned not in ("0", "false"):
+            if unassigned in self.unassigned:
+                lists.append(self.unassigned[unassigned])
+            else: # Còn trống ít nhất một slot
+                lists.append(sorted(set().union(*self.unassigned.values())))
+        if not lists:
+            return None
+        lists.sort(key=len)
+        if len(lists) == 1:
+            return lists[0]
+        return sorted(set(lists[0]).intersection(*lists[1:]))
+
+panel_state = PanelSnapshot(())
+panels_lock = threading.Lock() # Tuần tự hóa người ghi (luồng web server, tra tên server); người đọc không cần
+panel_store = None # Backend lưu cấu hình, khởi tạo trong load_panels()
+panel_writer = None # Luồng ghi nền gom các lần lưu
 bot_ready = False
-listener_bot = None
 is_kd_loop_enabled = True
+KD_INTERVAL = 605 # Số giây giữa hai lượt gửi 'kd' của cùng một panel
+WHEEL_TICK = 1 # Độ phân giải của bánh xe hẹn giờ (giây)
+main_loop = None # Event loop chính, để các luồng web server gửi coroutine vào
+sender_task = None # Task gửi 'kd' (hoặc giám sát worker), để /healthz biết nó còn chạy
+sender_heartbeat = None # time.monotonic() lần cuối vòng gửi chạy hết một nhịp
+loop_monitor = LoopMonitor(interval=float(os.getenv("LOOP_LAG_INTERVAL", "0.25")),
+                           stall_after=float(os.getenv("LOOP_STALL_SECONDS", "1.0")))
+
+# --- METRICS (/metrics) ---
+def _active_panels_by_slot():
+    counts = {}
+    for i in range(1, 4):
+        slot_key = f"slot_{i}"
+        counts[slot_key] = sum(1 for p in panel_state.panels if p.get("channel_id") and p.get("accounts", {}).get(slot_key))
+    return counts
+
+def _worker_counter(key):
+    """Ở tiến trình chính chế độ KD_WORKERS: tổng bộ đếm `key` của các worker, gộp vào /metrics."""
+    def collect():
+        if worker_supervisor is None:
+            return {}
+        return {(status,): value for status, value in worker_supervisor.counter_totals(key).items()}
+    return collect
+
+KD_SENDS = REGISTRY.counter("kd_sends_total", "Số lệnh 'kd' đã gửi, theo mã HTTP.", ["status"],
+                            collect=_worker_counter("kd_sends"))
+REACTIONS = REGISTRY.counter("kd_reactions_total", "Số reaction đã thả, theo mã HTTP.", ["status"],
+                             collect=_worker_counter("reactions"))
+SENDER_CYCLE = REGISTRY.histogram("kd_sender_cycle_seconds", "Thời gian gửi xong các lệnh 'kd' của một nhịp bánh xe.",
+                                  buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+LISTENER_EVENTS = REGISTRY.counter("listener_events_total", "Sự kiện bot lắng nghe nhận được.", ["event"])
+REGISTRY.gauge("kd_active_panels", "Số panel có kênh và tài khoản cho từng slot.", ["slot"], collect=_active_panels_by_slot)
 
 # --- CÁC HÀM TIỆN ÍCH & API DISCORD ---
 
-def send_message_http(token, channel_id, content):
-    """Gửi tin nhắn đến một kênh bằng requests, không cần bot instance."""
+async def send_message_http(token, channel_id, content, panel=None, slot=None):
+    """Gửi tin nhắn đến một kênh qua client HTTP dùng chung, không cần bot instance."""
     if not token or not channel_id: return
-    headers = {"Authorization": token}
-    payload = {"content": content}
-    url = f"https://discord.com/api/v9/channels/{channel_id}/messages"
+    fields = {"panel": panel, "slot": slot, "channel": channel_id}
+    started = time.perf_counter()
     try:
-        res = requests.post(url, headers=headers, json=payload, timeout=10)
-        if res.status_code == 200:
-            print(f"[HTTP SEND] Gửi '{content}' tới kênh {channel_id} thành công.")
+        status, data = await discord_request("POST", "/channels/{channel_id}/messages", token,
+                                             channel_id=channel_id, json={"content": content})
+        KD_SENDS.inc(status=status)
+        fields.update(status=status, latency=round(time.perf_counter() - started, 4))
+        if status == 200:
+            log.info("Gửi '%s' thành công", content, extra=fields)
         else:
-            print(f"[HTTP SEND ERROR] Lỗi khi gửi tin nhắn tới kênh {channel_id}: {res.status_code} {res.text}")
+            log.warning("Lỗi khi gửi '%s'", content, extra={**fields, "error": str(data)[:200]})
     except Exception as e:
-        print(f"[HTTP SEND EXCEPTION] Lỗi ngoại lệ khi gửi tin nhắn: {e}")
+        KD_SENDS.inc(status="exception")
+        log.error("Lỗi ngoại lệ khi gửi tin nhắn", extra={**fields, "error": repr(e)})
 
-def add_reaction_http(token, channel_id, message_id, emoji):
-    """Thả reaction vào tin nhắn bằng requests."""
+async def add_reaction_http(token, channel_id, message_id, emoji, panel=None, slot=None):
+    """Thả reaction vào tin nhắn qua client HTTP dùng chung."""
     if not token or not channel_id: return
-    headers = {"Authorization": token}
-    encoded_emoji = requests.utils.quote(emoji)
-    url = f"https://discord.com/api/v9/channels/{channel_id}/messages/{message_id}/reactions/{encoded_emoji}/@me"
+    fields = {"panel": panel, "slot": slot, "channel": channel_id, "message_id": message_id}
+    started = time.perf_counter()
     try:
-        res = requests.put(url, headers=headers, timeout=10)
-        if res.status_code != 204:
-             print(f"[HTTP REACT ERROR] Lỗi khi thả reaction {emoji} tới kênh {channel_id}: {res.status_code} {res.text}")
+        status, data = await discord_request("PUT", "/channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me", token,
+                                             channel_id=channel_id, message_id=message_id, emoji=quote(emoji))
+        REACTIONS.inc(status=status)
+        fields.update(status=status, latency=round(time.perf_counter() - started, 4))
+        if status != 204:
+            log.warning("Lỗi khi thả reaction %s", emoji, extra={**fields, "error": str(data)[:200]})
+        else:
+            log.debug("Đã thả reaction %s", emoji, extra=fields)
+        return status
     except Exception as e:
-        print(f"[HTTP REACT EXCEPTION] Lỗi ngoại lệ khi thả reaction: {e}")
+        REACTIONS.inc(status="exception")
+        log.error("Lỗi ngoại lệ khi thả reaction %s", emoji, extra={**fields, "error": repr(e)})
 
 # --- LƯU & TẢI CẤU HÌNH PANEL ---
-def save_panels():
-    """Lưu cấu hình các panel lên JSONBin.io"""
-    api_key = os.getenv("JSONBIN_API_KEY")
-    bin_id = os.getenv("JSONBIN_BIN_ID")
-    if not api_key or not bin_id:
-        print("[Settings] Thiếu API Key hoặc Bin ID của JSONBin. Bỏ qua việc lưu.")
+def publish_panels(new_panels):
+    """Đăng bản chụp mới thay cho bản cũ bằng một phép gán, rồi dựng lại bánh xe hẹn giờ.
+
+    Người ghi phải giữ panels_lock (trừ lúc khởi động) và không được sửa panel đã đăng.
+    """
+    global panel_state
+    old = panel_state
+    state = PanelSnapshot(new_panels, old.version + 1)
+    panel_state = state
+    kd_wheel.rebuild(state.panels, state.version)
+    if state.watched_channel_ids != old.watched_channel_ids and listener_pool is not None and main_loop is not None:
+        main_loop.call_soon_threadsafe(listener_pool.refresh_subscriptions)
+    return state
+
+def edit_panel(panel):
+    """Bản sao của panel để sửa trước khi đăng bản chụp mới."""
+    return {**panel, "accounts": dict(panel.get("accounts", {}))}
+
+def replace_panel(state, panel):
+    """Đăng bản chụp mới với panel (cùng id) thay cho bản cũ. Gọi khi giữ panels_lock."""
+    pid = panel.get("id")
+    return publish_panels([panel if p.get("id") == pid else p for p in state.panels])
+
+def snapshot_panels():
+    """Danh sách panel hiện tại cho luồng ghi. Panel đã đăng không bao giờ bị sửa nên không cần sao chép."""
+    return list(panel_state.panels)
+
+def save_panels(upserted=(), deleted=()):
+    """Đánh dấu các panel (theo id) cần lưu. Luồng ghi nền sẽ gom lại và ghi sau một khoảng lặng."""
+    if panel_writer is None:
+        log.warning("[Settings] Chưa khởi tạo nơi lưu trữ. Bỏ qua việc lưu.")
         return
-
-    headers = {'Content-Type': 'application/json', 'X-Master-Key': api_key}
-    url = f"https://api.jsonbin.io/v3/b/{bin_id}"
-    try:
-        def do_save():
-            req = requests.put(url, json=panels, headers=headers, timeout=15)
-            if req.status_code == 200:
-                print("[Settings] Đã lưu cấu hình panels lên JSONBin.io thành công.")
-            else:
-                print(f"[Settings] Lỗi khi lưu cài đặt: {req.status_code} - {req.text}")
-        threading.Thread(target=do_save, daemon=True).start()
-    except Exception as e:
-        print(f"[Settings] Exception khi lưu cài đặt: {e}")
+    panel_writer.mark(upserted=upserted, deleted=deleted)
 
 def load_panels():
-    """Tải cấu hình các panel từ JSONBin.io"""
-    global panels
-    api_key = os.getenv("JSONBIN_API_KEY")
-    bin_id = os.getenv("JSONBIN_BIN_ID")
-    if not api_key or not bin_id:
-        print("[Settings] Thiếu API Key hoặc Bin ID của JSONBin. Bắt đầu với cấu hình rỗng.")
-        return
+    """Tải cấu hình các panel từ backend lưu trữ (SQLite hoặc JSONBin.io)"""
+    global panel_store, panel_writer
+    panel_store = create_panel_store()
+    panels = panel_store.load()
+    missing_offsets = kd_wheel.assign_offsets(panels) # Panel cũ chưa có pha riêng, gán trước khi đăng
+    publish_panels(panels)
+    panel_writer = DebouncedWriter(panel_store, snapshot_panels,
+                                   quiet=float(os.getenv("SAVE_DEBOUNCE_SECONDS", "1.0")),
+                                   max_delay=float(os.getenv("SAVE_MAX_DELAY_SECONDS", "5.0")))
+    if missing_offsets:
+        save_panels(upserted=missing_offsets)
+    log.info("[Settings] Đã tải %d panel (backend: %s).", len(panels), panel_store.name, extra={"count": len(panels)})
+
+# --- TÊN SERVER (CACHE CÓ HẠN SỐNG) ---
+CHANNEL_GUILD_TTL = 24 * 3600 # Kênh gần như không bao giờ đổi server
+GUILD_NAME_TTL = 3600
+NEGATIVE_TTL = 300 # Kết quả lỗi (không tìm thấy, không có quyền) chỉ nhớ ngắn hạn
+SERVER_NAME_PENDING = "Đang tải tên server..."
+
+class TTLCache:
+    """Cache key -> value có hạn sống riêng cho từng mục, an toàn đa luồng."""
+    MISSING = object()
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return self.MISSING
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return self.MISSING
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+
+# channel_id -> (guild_id | None, lỗi | None); guild_id -> (tên | None, lỗi | None)
+channel_guild_cache = TTLCache(CHANNEL_GUILD_TTL)
+guild_name_cache = TTLCache(GUILD_NAME_TTL)
+_server_name_inflight = {} # channel_id -> asyncio.Task, gộp các lần tra cứu trùng nhau
+SERVER_NAME_CONCURRENCY = int(os.getenv("SERVER_NAME_CONCURRENCY", "8")) # Số kênh tra song song khi cập nhật hàng loạt
+
+def cached_server_name(channel_id):
+    """Tra tên server chỉ từ cache. Trả về (guild_id, tên) hoặc None nếu cần gọi API."""
+    if not channel_id or not channel_id.isdigit():
+        return None, "ID kênh không hợp lệ"
+    channel_entry = channel_guild_cache.get(channel_id)
+    if channel_entry is TTLCache.MISSING:
+        return None
+    guild_id, error = channel_entry
+    if error:
+        return None, error
+    name_entry = guild_name_cache.get(guild_id)
+    if name_entry is TTLCache.MISSING:
+        return None
+    name, error = name_entry
+    return guild_id, error or name
+
+async def _lookup_server_name(channel_id):
+    token = GLOBAL_ACCOUNTS[0]["token"]
 
-    headers = {'X-Master-Key': api_key, 'X-Bin-Meta': 'false'}
-    url = f"https://api.jsonbin.io/v3/b/{bin_id}/latest"
-    try:
-        req = requests.get(url, headers=headers, timeout=15)
-        if req.status_code == 200:
-            data = req.json()
-            if isinstance(data, list):
-                panels = data
-                print(f"[Settings] Đã tải {len(panels)} panel từ JSONBin.io.")
-            else:
-                save_panels()
+    # Bot lắng nghe thường đã có sẵn kênh và server trong cache của nó
+    channel = listener_pool.get_channel(int(channel_id)) if listener_pool else None
+    guild = getattr(channel, "guild", None)
+    if guild is not None:
+        channel_guild_cache.set(channel_id, (str(guild.id), None))
+        guild_name_cache.set(str(guild.id), (guild.name, None))
+        return str(guild.id), guild.name
+
+    channel_entry = channel_guild_cache.get(channel_id)
+    if channel_entry is TTLCache.MISSING:
+        status, channel_data = await discord_request("GET", "/channels/{channel_id}", token, channel_id=channel_id)
+        if status != 200:
+            channel_entry = (None, "Không tìm thấy kênh")
+            channel_guild_cache.set(channel_id, channel_entry, NEGATIVE_TTL)
+        elif not channel_data.get("guild_id"):
+            channel_entry = (None, "Đây là kênh DM/Group")
+            channel_guild_cache.set(channel_id, channel_entry)
         else:
-            print(f"[Settings] Lỗi khi tải cài đặt: {req.status_code} - {req.text}")
-    except Exception as e:
-        print(f"[Settings] Exception khi tải cài đặt: {e}")
-
-def get_server_name_from_channel(channel_id):
-    """Lấy tên server từ Channel ID thông qua Discord API."""
-    if not channel_id or not channel_id.isdigit():
-        return "ID kênh không hợp lệ"
+            channel_entry = (channel_data["guild_id"], None)
+            channel_guild_cache.set(channel_id, channel_entry)
+    guild_id, error = channel_entry
+    if error:
+        return None, error
+
+    name_entry = guild_name_cache.get(guild_id)
+    if name_entry is TTLCache.MISSING:
+        status, guild_data = await discord_request("GET", "/guilds/{guild_id}", token, guild_id=guild_id)
+        if status == 200:
+            name_entry = (guild_data.get("name", "Không thể lấy tên server"), None)
+            guild_name_cache.set(guild_id, name_entry)
+        else:
+            name_entry = (None, "Không thể truy cập server")
+            guild_name_cache.set(guild_id, name_entry, NEGATIVE_TTL)
+    name, error = name_entry
+    return guild_id, error or name
+
+async def fetch_server_name(channel_id):
+    """Lấy (guild_id, tên server) từ Channel ID, ưu tiên cache (chạy trên event loop)."""
+    cached = cached_server_name(channel_id)
+    if cached is not None:
+        return cached
     if not GLOBAL_ACCOUNTS:
-        return "Không có token để xác thực"
-
-    token = GLOBAL_ACCOUNTS[0]["token"]
-    headers = {"Authorization": token}
+        return None, "Không có token để xác thực"
 
+    task = _server_name_inflight.get(channel_id)
+    if task is None:
+        task = asyncio.ensure_future(_lookup_server_name(channel_id))
+        _server_name_inflight[channel_id] = task
+        task.add_done_callback(lambda _: _server_name_inflight.pop(channel_id, None))
     try:
-        channel_res = requests.get(f"https://discord.com/api/v9/channels/{channel_id}", headers=headers, timeout=10)
-        if channel_res.status_code != 200:
-            return "Không tìm thấy kênh"
-
-        channel_data = channel_res.json()
-        guild_id = channel_data.get("guild_id")
-
-        if not guild_id:
-            return "Đây là kênh DM/Group"
-
-        guild_res = requests.get(f"https://discord.com/api/v9/guilds/{guild_id}", headers=headers, timeout=10)
-        if guild_res.status_code == 200:
-            return guild_res.json().get("name", "Không thể lấy tên server")
-        else:
-            return "Không thể truy cập server"
+        return await asyncio.shield(task)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None, "Lỗi mạng"
+
+async def resolve_panel_server_names(pairs):
+    """Tra tên server cho các cặp (panel_id, channel_id) ở nền, tối đa SERVER_NAME_CONCURRENCY kênh cùng lúc,
+    rồi cập nhật mọi panel trong một bản chụp, một lần lưu và đẩy sự kiện tới dashboard.
+    """
+    semaphore = asyncio.Semaphore(SERVER_NAME_CONCURRENCY)
+
+    async def lookup(channel_id):
+        async with semaphore:
+            try:
+                return await fetch_server_name(channel_id)
+            except Exception as e:
+                log.warning("[SERVER NAME] Lỗi khi tra tên server", extra={"channel": channel_id, "error": repr(e)})
+                return None, "Lỗi mạng"
+
+    channel_ids = list(dict.fromkeys(channel_id for _, channel_id in pairs))
+    results = dict(zip(channel_ids, await asyncio.gather(*(lookup(cid) for cid in channel_ids))))
+    # Đăng bản chụp mới phải dựng lại chỉ mục và kế hoạch gửi, lại có thể chờ panels_lock: không làm trên event loop
+    await asyncio.to_thread(apply_server_names, dict(pairs), results)
+
+def apply_server_names(wanted, results):
+    """Ghi tên server đã tra vào các panel (panel_id -> channel_id) trong một bản chụp và một lần lưu."""
+    updated = []
+    with panels_lock:
+        panels = list(panel_state.panels)
+        for i, panel in enumerate(panels):
+            channel_id = wanted.get(panel.get('id'))
+            # Bỏ qua nếu channel_id đã đổi trong lúc chờ; panel đã bị xóa thì không còn trong danh sách
+            if channel_id is None or panel.get('channel_id') != channel_id:
+                continue
+            guild_id, server_name = results[channel_id]
+            panels[i] = {**panel, 'server_name': server_name, 'guild_id': guild_id or ""}
+            updated.append(panels[i])
+        if updated:
+            publish_panels(panels)
+    if updated:
+        save_panels(upserted=[p['id'] for p in updated])
+        for panel in updated:
+            publish_panel(panel)
+
+async def backfill_guild_ids():
+    """Panel lưu từ trước khi có trường guild_id: tra lại ở nền để bộ lọc theo server trên /api/panels thấy chúng."""
+    pairs = [(p["id"], p["channel_id"]) for p in panel_state.panels if p.get("channel_id") and not p.get("guild_id")]
+    if pairs:
+        log.info("[SERVER NAME] Bổ sung guild_id cho %d panel cũ", len(pairs), extra={"count": len(pairs)})
+        await resolve_panel_server_names(pairs)
+
+async def resolve_panel_server_name(panel_id, channel_id):
+    """Tra tên server của một panel ở nền rồi cập nhật panel và đẩy sự kiện tới dashboard."""
+    await resolve_panel_server_names([(panel_id, channel_id)])
+
+def prefill_server_name(panel, channel_id):
+    """Điền tên server từ cache. Trả về True nếu cần tra ở nền (panel đã được đánh dấu đang tải).
+
+    Phải gọi khi đang giữ panels_lock, trên bản sao panel chưa đăng.
+    """
+    cached = cached_server_name(channel_id)
+    if cached is not None:
+        panel['guild_id'], panel['server_name'] = cached[0] or "", cached[1]
+        return False
+    panel['guild_id'] = ""
+    if main_loop is None or not main_loop.is_running():
+        panel['server_name'] = "Bot chưa khởi động xong"
+        return False
+    panel['server_name'] = SERVER_NAME_PENDING
+    return True
+
+def schedule_server_name(panel, channel_id):
+    """Gán tên server cho panel: lấy ngay nếu đã có trong cache, nếu không thì tra ở nền."""
+    if prefill_server_name(panel, channel_id):
+        asyncio.run_coroutine_threadsafe(resolve_panel_server_name(panel['id'], channel_id), main_loop)
 
-    except requests.RequestException:
-        return "Lỗi mạng"
-        
 # --- LOGIC BOT CHÍNH ---
 
+class KdScheduler:
+    """Lịch gửi 'kd' theo mốc tuyệt đối trên đồng hồ monotonic.
+
+    Lượt thứ n luôn rơi vào start + n * interval (cộng thêm thời gian tạm dừng), nên thời gian gửi
+    không làm lệch nhịp. Khi tạm dừng, phần thời gian còn lại được giữ nguyên để tiếp tục đúng pha.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_deadline = None # Theo time.monotonic(); None khi chưa bắt đầu
+        self.paused_remaining = None # Số giây còn lại lúc tạm dừng
+        self.cycles = 0
+        self.wall_offset = 0.0 # time.time() - time.monotonic(), chụp một lần lúc bắt đầu / tiếp tục
+        self._changed = asyncio.Event()
+
+    def _anchor_wall_clock(self):
+        # Đổi mốc monotonic sang giờ thật bằng một độ lệch cố định để next_fire_at không dao động giữa các lần gọi
+        self.wall_offset = time.time() - time.monotonic()
+
+    def start(self, enabled=True):
+        """Bắt đầu lịch: lượt đầu tiên chạy ngay."""
+        self._anchor_wall_clock()
+        self.next_deadline = time.monotonic()
+        if not enabled:
+            self.paused_remaining = 0.0
+
+    def set_enabled(self, enabled):
+        """Tạm dừng / tiếp tục. Chỉ gọi trên event loop (từ luồng khác dùng call_soon_threadsafe)."""
+        if self.next_deadline is None:
+            return
+        now = time.monotonic()
+        if not enabled and self.paused_remaining is None:
+            self.paused_remaining = max(0.0, self.next_deadline - now)
+        elif enabled and self.paused_remaining is not None:
+            self.next_deadline = now + self.paused_remaining
+            self.paused_remaining = None
+            self._anchor_wall_clock()
+        self._changed.set()
+
+    def advance(self):
+        """Chuyển sang mốc kế tiếp. Nếu đã trễ quá một nhịp thì lượt sau chạy ngay chứ không bỏ lượt."""
+        self.cycles += 1
+        self.next_deadline += self.interval
+
+    def seconds_until_next(self):
+        if self.next_deadline is None:
+            return None
+        if self.paused_remaining is not None:
+            return self.paused_remaining
+        return max(0.0, self.next_deadline - time.monotonic())
+
+    def next_fire_at(self):
+        """Thời điểm (epoch giây) của lượt kế tiếp, None nếu đang tạm dừng hoặc chưa bắt đầu."""
+        if self.next_deadline is None or self.paused_remaining is not None:
+            return None
+        return round(self.next_deadline + self.wall_offset, 3)
+
+    async def wait_until_due(self):
+        """Ngủ tới mốc kế tiếp; thức dậy sớm để tính lại khi bị tạm dừng / tiếp tục."""
+        while True:
+            self._changed.clear()
+            if self.paused_remaining is not None:
+                await self._changed.wait()
+                continue
+            delay = self.next_deadline - time.monotonic()
+            if delay <= 0:
+                return
+            try:
+                await asyncio.wait_for(self._changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+SLOT_KEYS = ("slot_1", "slot_2", "slot_3")
+
+class DispatchPlan:
+    """Kế hoạch gửi 'kd' dựng sẵn từ một bản chụp panel, chỉ dựng lại khi cấu hình đổi.
+
+    ids[i] là id của panel thứ i; slots[s][i] là (token, channel_id) panel i gửi khi tới lượt slot s,
+    hoặc None nếu slot đó chưa đủ tài khoản/kênh; buckets[ô] là tuple chỉ số panel của ô đó.
+    """
+    __slots__ = ("version", "ids", "slots", "buckets")
+
+    def __init__(self, panels, size, version=0):
+        self.version = version
+        self.ids = tuple(p.get("id") for p in panels)
+        slots = []
+        for slot_key in SLOT_KEYS:
+            items = []
+            for p in panels:
+                token = p.get("accounts", {}).get(slot_key)
+                channel_id = p.get("channel_id")
+                items.append((token, channel_id) if token and channel_id else None)
+            slots.append(tuple(items))
+        self.slots = tuple(slots)
+        buckets = [[] for _ in range(size)]
+        for i, p in enumerate(panels):
+            offset = p.get("kd_offset")
+            if isinstance(offset, int) and 0 <= offset < size:
+                buckets[offset].append(i)
+        self.buckets = tuple(tuple(b) for b in buckets)
+
+class KdTimerWheel:
+    """Bánh xe hẹn giờ cho vòng 'kd': mỗi panel có pha riêng (kd_offset).
+
+    Một vòng gồm `size` ô, mỗi ô ứng với một nhịp WHEEL_TICK giây. Panel nằm ở ô kd_offset và gửi
+    'kd' mỗi khi kim đi qua ô đó, nên tải được rải đều trong KD_INTERVAL thay vì dồn vào một thời điểm.
+    Slot được suy ra từ số vòng đã quay (tick // size) nên mỗi panel đổi slot sau mỗi lần gửi mà không cần
+    trạng thái riêng từng panel; chỉ event loop (take_due) thay đổi tick.
+    """
+    GOLDEN = 0.6180339887498949
+
+    def __init__(self, size):
+        self.size = size
+        self.plan = DispatchPlan((), size) # Thay nguyên khối mỗi khi cấu hình đổi
+        self.tick = 0 # Số thứ tự tuyệt đối của nhịp kế tiếp; ô = tick % size, vòng = tick // size
+
+    @property
+    def buckets(self):
+        return self.plan.buckets
+
+    @property
+    def position(self):
+        """Ô sẽ chạy ở nhịp kế tiếp."""
+        return self.tick % self.size
+
+    def rebuild(self, panels, version=0):
+        self.plan = DispatchPlan(panels, self.size, version)
+
+    def pick_offset(self, loads=None):
+        """Chọn ô ít panel nhất; khi hòa thì đi theo dãy tỉ lệ vàng để các panel thêm dần vẫn rải đều."""
+        if loads is None:
+            loads = [len(b) for b in self.buckets]
+        least = min(loads)
+        for k in range(self.size * 2):
+            offset = int((k * self.GOLDEN) % 1 * self.size)
+            if loads[offset] == least:
+                return offset
+        return loads.index(least)
+
+    def assign_offsets(self, panels):
+        """Gán kd_offset cho các panel chưa có. Trả về danh sách id đã được gán."""
+        loads = [0] * self.size
+        for p in panels:
+            offset = p.get("kd_offset")
+            if isinstance(offset, int) and 0 <= offset < self.size:
+                loads[offset] += 1
+        assigned = []
+        for p in panels:
+            offset = p.get("kd_offset")
+            if not (isinstance(offset, int) and 0 <= offset < self.size):
+                p["kd_offset"] = self.pick_offset(loads)
+                loads[p["kd_offset"]] += 1
+                assigned.append(p.get("id"))
+        return assigned
+
+    def take_due(self):
+        """Lấy (kế hoạch, chỉ số các panel ở ô hiện tại, slot dùng ở nhịp này) và quay kim sang ô kế tiếp."""
+        plan = self.plan
+        tick = self.tick
+        due = plan.buckets[tick % self.size]
+        self.tick = tick + 1
+        return plan, due, self.slot_at(tick)
+
+    def slot_at(self, tick):
+        """Slot (0-2) các panel dùng khi gửi ở nhịp tick: mỗi vòng bánh xe chuyển sang slot kế tiếp."""
+        return (tick // self.size) % len(SLOT_KEYS)
+
+    def next_slot(self, ticks_ahead=0):
+        return self.slot_at(self.tick + ticks_ahead)
+
+    def next_due(self):
+        """(số nhịp tới ô có panel gần nhất, id panel đầu tiên ở ô đó), hoặc (None, None) nếu bánh xe rỗng."""
+        plan = self.plan
+        for i in range(self.size):
+            due = plan.buckets[(self.position + i) % self.size]
+            if due:
+                return i, plan.ids[due[0]]
+        return None, None
+
+kd_scheduler = KdScheduler(WHEEL_TICK)
+kd_wheel = KdTimerWheel(int(KD_INTERVAL / WHEEL_TICK))
+_fire_tasks = set()
+
+async def fire_panels(plan, indices, slot=0):
+    """Gửi 'kd' bằng tài khoản ở slot cho các panel (theo chỉ số trong plan) tới lượt.
+
+    Trả về số lệnh đã gửi.
+    """
+    started = time.perf_counter()
+    ids, items = plan.ids, plan.slots[slot]
+    tasks = []
+    for i in indices:
+        item = items[i]
+        if item is not None:
+            tasks.append(send_message_http(item[0], item[1], "kd", panel=ids[i], slot=SLOT_KEYS[slot]))
+    if tasks:
+        log.info("Gửi %d lệnh 'kd' cho các panel tới lượt", len(tasks), extra={"count": len(tasks)})
+        await asyncio.gather(*tasks)
+    SENDER_CYCLE.observe(time.perf_counter() - started)
+    return len(tasks)
+
 async def drop_sender_loop():
-    """Vòng lặp gửi 'kd', luân phiên giữa các slot tài khoản."""
-    global current_drop_slot
-    print("Vòng lặp gửi 'kd' đang chờ bot sẵn sàng...")
+    """Vòng lặp gửi 'kd': mỗi nhịp quay bánh xe một ô và gửi cho các panel ở ô đó, theo lịch không trôi."""
+    log.info("Vòng lặp gửi 'kd' đang chờ bot sẵn sàng...")
     while not bot_ready:
         await asyncio.sleep(1)
-    print("Bot đã sẵn sàng. Bắt đầu vòng lặp gửi 'kd'.")
+    log.info("Bot đã sẵn sàng. Bắt đầu vòng lặp gửi 'kd'.")
+    global sender_heartbeat
+    kd_scheduler.start(is_kd_loop_enabled)
+    publish_status()
 
     while True:
-        if not is_kd_loop_enabled:
-            await asyncio.sleep(5)
-            continue
-        
-        try:
-            slot_key = f"slot_{current_drop_slot + 1}"
-            print(f"\n--- Đang trong lượt của Slot {current_drop_slot + 1} ---")
-
-            tasks = []
-            active_sends = 0
-            for panel in panels:
-                channel_id = panel.get("channel_id")
-                token_to_use = panel.get("accounts", {}).get(slot_key)
-
-                if token_to_use and channel_id:
-                    task = asyncio.to_thread(send_message_http, token_to_use, channel_id, "kd")
-                    tasks.append(task)
-                    active_sends +=1
-                
-            if tasks:
-                print(f"Gửi đồng thời {active_sends} lệnh 'kd' cho các tài khoản ở {slot_key}...")
-                await asyncio.gather(*tasks)
-            else:
-                print(f"Không có tài khoản nào được cấu hình cho {slot_key} trong bất kỳ panel nào.")
-
-            current_drop_slot = (current_drop_slot + 1) % 3
-
-            print(f"Đã xong lượt. Chờ 605 giây cho lượt kế tiếp (Slot {current_drop_slot + 1})...")
-            await asyncio.sleep(605)
-
-        except Exception as e:
-            print(f"[DROP SENDER ERROR] Lỗi nghiêm trọng trong vòng lặp gửi 'kd': {e}")
-            await asyncio.sleep(60)
-
-async def handle_reactions(panel, message):
+        await kd_scheduler.wait_until_due()
+        plan, due, slot = kd_wheel.take_due()
+        kd_scheduler.advance()
+        sender_heartbeat = time.monotonic()
+        if due:
+            # Chạy nền để một nhịp gửi chậm không làm trễ nhịp sau
+            task = asyncio.create_task(fire_panels(plan, due, slot))
+            _fire_tasks.add(task)
+            task.add_done_callback(_fire_tasks.discard)
+            publish_status()
+
+# --- THEO DÕI ĐỘ TRỄ DROP ---
+DISCORD_EPOCH = 1420070400000
+drop_latency = LatencyTracker()
+recent_drop_traces = deque(maxlen=100)
+
+def snowflake_time(snowflake_id):
+    """Thời điểm (epoch giây) Discord tạo ra một snowflake ID."""
+    return ((int(snowflake_id) >> 22) + DISCORD_EPOCH) / 1000
+
+def record_drop_trace(trace):
+    """Tách trace thành độ trễ từng giai đoạn và đưa vào cửa sổ thống kê.
+
+    gateway: Discord tạo tin nhắn -> bot nhận (gồm cả lệch đồng hồ)
+    lookup: nhận -> tìm xong panel; dispatch: tìm xong -> task reaction bắt đầu chạy
+    sleep_overshoot: ngủ trễ hơn lịch; reaction_http: thức dậy -> request reaction xong
+    slot_N_total / end_to_end: Discord tạo tin nhắn -> reaction xong
+    """
+    drop_latency.record("gateway", trace["received_at"] - trace["created_at"])
+    drop_latency.record("lookup", trace["lookup_at"] - trace["received_at"])
+    drop_latency.record("dispatch", trace["task_start_at"] - trace["lookup_at"])
+    done = []
+    for r in trace["reactions"]:
+        drop_latency.record("sleep_overshoot", r["woke_at"] - r["scheduled_at"])
+        drop_latency.record("reaction_http", r["done_at"] - r["woke_at"])
+        drop_latency.record(f"{r['slot']}_total", r["done_at"] - trace["created_at"])
+        done.append(r["done_at"])
+    if done:
+        drop_latency.record("end_to_end", max(done) - trace["created_at"])
+    recent_drop_traces.append(trace)
+
+async def handle_reactions(panel, message, trace=None):
     """Xử lý việc thả reaction cho 3 tài khoản trong một panel."""
     accounts_in_panel = panel.get("accounts", {})
     if not accounts_in_panel: return
+    if trace is None:
+        now = time.time()
+        trace = {"created_at": snowflake_time(message.id), "received_at": now, "lookup_at": now}
+    task_start = time.time()
+    trace.update(message_id=str(message.id), channel_id=str(message.channel.id), panel_id=panel.get("id"),
+                 task_start_at=task_start, reactions=[])
 
     emojis = ["1️⃣", "2️⃣", "3️⃣"]
     grab_times = [1.3, 2.3, 3.2]
@@ -204,64 +728,627 @@ async def handle_reactions(panel, message):
         if token:
             delay = grab_times[i]
             emoji = emojis[i]
-            async def react_task(t, ch_id, msg_id, em, d):
+            async def react_task(t, ch_id, msg_id, em, d, slot):
                 await asyncio.sleep(d)
-                await asyncio.to_thread(add_reaction_http, t, ch_id, msg_id, em)
+                woke_at = time.time()
+                status = await add_reaction_http(t, ch_id, msg_id, em, panel=panel.get("id"), slot=slot)
+                trace["reactions"].append({"slot": slot, "scheduled_at": task_start + d, "woke_at": woke_at,
+                                           "done_at": time.time(), "status": status})
             
-            tasks.append(react_task(token, message.channel.id, message.id, emoji, delay))
+            tasks.append(react_task(token, message.channel.id, message.id, emoji, delay, slot_key))
 
     if tasks:
         await asyncio.gather(*tasks)
-        print(f"Đã hoàn thành các tác vụ reaction cho drop trong kênh {message.channel.id}")
+        record_drop_trace(trace)
+        log.info("Đã hoàn thành các tác vụ reaction cho drop", extra={
+            "panel": panel.get("id"), "channel": message.channel.id, "message_id": message.id,
+            "latency": round(time.time() - trace["created_at"], 4)})
+
+async def on_drop_message(message):
+    """Lọc tin nhắn drop của Karuta và lên lịch thả reaction cho panel của kênh đó."""
+    received_at = time.time()
+    LISTENER_EVENTS.inc(event="message")
+    if message.author.id != KARUTA_ID or "is dropping 3 cards!" not in message.content:
+        return
+    LISTENER_EVENTS.inc(event="karuta_drop")
+
+    found_panel = panel_state.by_channel.get(str(message.channel.id))
+    if found_panel:
+        trace = {"created_at": snowflake_time(message.id), "received_at": received_at, "lookup_at": time.time()}
+        LISTENER_EVENTS.inc(event="drop_matched")
+        log.info("Phát hiện drop (panel '%s')", found_panel.get('name'), extra={
+            "panel": found_panel.get("id"), "channel": message.channel.id, "message_id": message.id,
+            "latency": round(trace["lookup_at"] - trace["created_at"], 4)})
+        if worker_supervisor is not None:
+            worker_supervisor.forward_drop(found_panel, message, trace)
+        else:
+            asyncio.create_task(handle_reactions(found_panel, message, trace))
+
+# --- NHÓM BOT LẮNG NGHE (NHIỀU KẾT NỐI GATEWAY) ---
+# Số tài khoản đầu tiên trong TOKENS dùng để lắng nghe, mỗi tài khoản một kết nối gateway
+LISTENER_ACCOUNTS = max(1, int(os.getenv("LISTENER_ACCOUNTS", "1")))
+# Chế độ gọn: tắt cache tin nhắn/thành viên và chỉ đăng ký nhận sự kiện của các server có panel
+LISTENER_LEAN = os.getenv("LISTENER_LEAN", "1").strip().lower() not in ("0", "false", "no")
+# Chế độ gọn vẫn có thể đăng ký mọi server nếu muốn (tốn bộ nhớ hơn với server lớn)
+LISTENER_SUBSCRIBE_ALL = os.getenv("LISTENER_SUBSCRIBE_ALL", "0").strip().lower() in ("1", "true", "yes")
+
+def listener_client_options():
+    """Tham số cho client discord.py-self của bot lắng nghe."""
+    if not LISTENER_LEAN:
+        return {}
+    return {
+        "max_messages": None, # Không giữ cache tin nhắn, on_message vẫn nhận đủ
+        "chunk_guilds_at_startup": False,
+        "member_cache_flags": discord.MemberCacheFlags.none(),
+        "guild_subscriptions": LISTENER_SUBSCRIBE_ALL,
+    }
+
+class ListenerShard:
+    """Một kết nối gateway của nhóm lắng nghe."""
+
+    def __init__(self, index, account):
+        self.index = index
+        self.account = account
+        self.client = None
+        self.connected = False
+        self.failed = None # Lý do dừng hẳn (vd token sai)
+        self.guild_ids = set() # Các server tài khoản này đang ở
+        self.subscribed = set() # Các server đã đăng ký nhận sự kiện (chế độ gọn)
+
+    def info(self, assigned):
+        return {"index": self.index, "account_id": self.account["id"], "name": self.account["name"],
+                "connected": self.connected, "failed": self.failed,
+                "guilds": len(self.guild_ids), "assigned_guilds": assigned}
+
+class ListenerPool:
+    """Chia các server cho nhiều kết nối: mỗi server chỉ do một kết nối xử lý drop.
+
+    Server được giao cho kết nối đang online có ít server nhất trong số các kết nối là thành viên.
+    Khi một kết nối rớt, các server của nó được giao lại cho kết nối khác ngay.
+    Chạy hoàn toàn trên event loop chính nên không cần lock.
+    """
+
+    def __init__(self, accounts):
+        self.shards = [ListenerShard(i, acc) for i, acc in enumerate(accounts)]
+        self.owner_by_guild = {} # guild_id -> index của kết nối xử lý server đó
+
+    def owns(self, shard, guild_id):
+        return self.owner_by_guild.get(guild_id) == shard.index
+
+    def assigned_counts(self):
+        counts = [0] * len(self.shards)
+        for index in self.owner_by_guild.values():
+            counts[index] += 1
+        return counts
+
+    def rebalance(self):
+        """Giữ nguyên chủ cũ nếu còn hợp lệ, giao các server mồ côi cho kết nối ít việc nhất rồi san đều."""
+        online = [s for s in self.shards if s.connected]
+        members = {}
+        for shard in online:
+            for guild_id in shard.guild_ids:
+                members.setdefault(guild_id, []).append(shard)
+        owners = {}
+        counts = [0] * len(self.shards)
+        orphans = []
+        for guild_id, candidates in members.items():
+            owner = self.owner_by_guild.get(guild_id)
+            if owner is not None and any(s.index == owner for s in candidates):
+                owners[guild_id] = owner
+                counts[owner] += 1
+            else:
+                orphans.append(guild_id)
+        for guild_id in orphans:
+            shard = min(members[guild_id], key=lambda s: (counts[s.index], s.index))
+            owners[guild_id] = shard.index
+            counts[shard.index] += 1
+        # Cân bằng lại: chỉ chuyển server khi chênh lệch từ 2 trở lên để tránh chuyển qua chuyển lại
+        for guild_id, candidates in members.items():
+            owner = owners[guild_id]
+            target = min(candidates, key=lambda s: (counts[s.index], s.index))
+            if counts[owner] - counts[target.index] >= 2:
+                owners[guild_id] = target.index
+                counts[owner] -= 1
+                counts[target.index] += 1
+        lost = len(set(self.owner_by_guild) - set(owners))
+        self.owner_by_guild = owners
+        LISTENER_EVENTS.inc(event="rebalance")
+        log.info("[LISTENER] Chia lại server: %d server cho %d/%d kết nối", len(owners), len(online), len(self.shards),
+                 extra={"count": len(owners)})
+        if lost:
+            log.warning("[LISTENER] %d server không còn kết nối nào theo dõi", lost, extra={"count": lost})
+        self.refresh_subscriptions() # Chủ mới của các server vừa chuyển phải đăng ký nhận sự kiện
+
+    def get_channel(self, channel_id):
+        """Tìm kênh trong cache của bất kỳ kết nối nào đang online."""
+        for shard in self.shards:
+            if shard.connected and shard.client is not None:
+                channel = shard.client.get_channel(channel_id)
+                if channel is not None:
+                    return channel
+        return None
+
+    def status(self):
+        counts = self.assigned_counts()
+        return [s.info(counts[s.index]) for s in self.shards]
+
+    def watched_guild_ids(self):
+        """Các server chứa kênh có panel, tra từ cache kênh của các kết nối."""
+        guild_ids = set()
+        for channel_id in panel_state.watched_channel_ids:
+            channel = self.get_channel(channel_id)
+            guild = getattr(channel, "guild", None)
+            if guild is not None:
+                guild_ids.add(guild.id)
+        return guild_ids
+
+    def refresh_subscriptions(self):
+        """Chế độ gọn: đăng ký nhận sự kiện cho các server có panel, chỉ trên kết nối đang giữ server đó.
+
+        Mỗi server chỉ một kết nối nhận và giải mã sự kiện nên công việc được chia đều cho các kết nối.
+        Khi chuyển chủ, chủ mới đăng ký ngay trong rebalance(); đăng ký cũ của chủ trước không gỡ được
+        nên vẫn nhận sự kiện tới hết phiên đó, on_message bỏ qua vì không còn là chủ.
+        """
+        if not LISTENER_LEAN or LISTENER_SUBSCRIBE_ALL:
+            return
+        for guild_id in self.watched_guild_ids():
+            owner = self.owner_by_guild.get(guild_id)
+            if owner is None:
+                continue
+            shard = self.shards[owner]
+            if not shard.connected or guild_id in shard.subscribed:
+                continue
+            guild = shard.client.get_guild(guild_id)
+            if guild is not None:
+                shard.subscribed.add(guild_id)
+                asyncio.create_task(self._subscribe(shard, guild))
+
+    async def _subscribe(self, shard, guild):
+        try:
+            # typing=True là bắt buộc để nhận tin nhắn từ server lớn
+            await guild.subscribe(typing=True, activities=False, threads=False, member_updates=False)
+        except Exception as e:
+            shard.subscribed.discard(guild.id)
+            log.warning("[LISTENER] Kết nối #%d không đăng ký được server", shard.index + 1,
+                        extra={"account": shard.account["id"], "guild": guild.id, "error": repr(e)})
+
+    def memory_report(self):
+        """RSS của tiến trình và số đối tượng trong cache của từng kết nối."""
+        shards = []
+        for shard in self.shards:
+            client = shard.client
+            guilds = client.guilds if client is not None else []
+            shards.append({
+                "account_id": shard.account["id"],
+                "connected": shard.connected,
+                "guilds": len(guilds),
+                "channels": sum(len(g.channels) for g in guilds),
+                "members": sum(len(g.members) for g in guilds),
+                "cached_messages": len(client.cached_messages) if client is not None else 0,
+                "subscribed_guilds": len(shard.subscribed),
+            })
+        return {"lean": LISTENER_LEAN, "rss_bytes": process_rss_bytes(), "shards": shards}
+
+    def _make_client(self, shard):
+        if LISTENER_LEAN:
+            # Bot chỉ cần on_message, không cần bộ xử lý lệnh của commands.Bot
+            client = discord.Client(**listener_client_options())
+        else:
+            client = commands.Bot(command_prefix="!слушать", self_bot=True)
+
+        def sync_guilds(connected):
+            shard.connected = connected
+            if connected:
+                shard.guild_ids = {g.id for g in client.guilds}
+            else:
+                shard.subscribed.clear() # Phiên mới phải đăng ký lại
+            self.rebalance()
+            publish_status()
+
+        @client.event
+        async def on_ready():
+            global bot_ready
+            log.info("BOT LẮNG NGHE #%d ĐÃ SẴN SÀNG! Đăng nhập với tài khoản: %s (ID: %s), %d server",
+                     shard.index + 1, client.user, client.user.id, len(client.guilds),
+                     extra={"account": shard.account["id"], "count": len(client.guilds)})
+            bot_ready = True
+            sync_guilds(True)
+
+        @client.event
+        async def on_resumed():
+            sync_guilds(True)
+
+        @client.event
+        async def on_disconnect():
+            if shard.connected:
+                log.warning("[LISTENER] Kết nối #%d (%s) bị ngắt.", shard.index + 1, shard.account['name'],
+                            extra={"account": shard.account["id"]})
+                sync_guilds(False)
+
+        @client.event
+        async def on_guild_join(guild):
+            shard.guild_ids.add(guild.id)
+            self.rebalance()
+
+        @client.event
+        async def on_guild_remove(guild):
+            shard.guild_ids.discard(guild.id)
+            shard.subscribed.discard(guild.id)
+            self.rebalance()
+
+        @client.event
+        async def on_message(message):
+            # Bỏ qua sớm kênh không có panel; server không giao cho kết nối này thì để kết nối khác xử lý
+            if message.channel.id not in panel_state.watched_channel_ids:
+                LISTENER_EVENTS.inc(event="ignored")
+                return
+            guild = message.guild
+            if guild is None or not self.owns(shard, guild.id):
+                return
+            await on_drop_message(message)
+
+        return client
+
+    async def _run_shard(self, shard):
+        shard.client = self._make_client(shard)
+        try:
+            await shard.client.start(shard.account["token"])
+        except discord.errors.LoginFailure:
+            shard.failed = "Đăng nhập thất bại"
+            log.critical("LỖI ĐĂNG NHẬP NGHIÊM TRỌNG với token của bot lắng nghe #%d (%s). Vui lòng kiểm tra TOKENS trong file .env.",
+                         shard.index + 1, shard.account['name'], extra={"account": shard.account["id"]})
+        except Exception as e:
+            shard.failed = str(e)
+            log.exception("Lỗi không xác định với bot lắng nghe #%d", shard.index + 1,
+                          extra={"account": shard.account["id"], "error": repr(e)})
+        finally:
+            if shard.connected:
+                shard.connected = False
+                self.rebalance()
+
+    async def run(self):
+        await asyncio.gather(*(self._run_shard(s) for s in self.shards))
+
+listener_pool = None
+
+def _listener_shard_states():
+    shards = listener_pool.shards if listener_pool else []
+    return {"connected": sum(s.connected for s in shards), "total": len(shards)}
+
+def _listener_assigned_guilds():
+    return {info["account_id"]: info["assigned_guilds"] for info in listener_pool.status()} if listener_pool else {}
+
+def _listener_cache_objects():
+    if listener_pool is None:
+        return {}
+    totals = {}
+    for shard in listener_pool.memory_report()["shards"]:
+        for kind in ("guilds", "channels", "members", "cached_messages"):
+            totals[kind] = totals.get(kind, 0) + shard[kind]
+    return totals
+
+REGISTRY.gauge("process_resident_memory_bytes", "RSS của tiến trình (byte).",
+               collect=lambda: {(): process_rss_bytes() or 0})
+REGISTRY.gauge("listener_cache_objects", "Số đối tượng trong cache của các kết nối lắng nghe.", ["kind"],
+               collect=_listener_cache_objects)
+REGISTRY.gauge("listener_shards", "Số kết nối lắng nghe đang online / tổng số.", ["state"], collect=_listener_shard_states)
+REGISTRY.gauge("listener_assigned_guilds", "Số server giao cho từng kết nối lắng nghe.", ["account"],
+               collect=_listener_assigned_guilds)
 
 async def run_listener_bot():
-    """Chạy một bot duy nhất để lắng nghe sự kiện drop."""
-    global bot_ready, listener_bot
+    """Chạy nhóm bot lắng nghe sự kiện drop (LISTENER_ACCOUNTS tài khoản đầu tiên)."""
+    global bot_ready, listener_pool
     if not GLOBAL_ACCOUNTS:
-        print("Không có token nào trong biến môi trường. Bot không thể khởi động.")
+        log.error("Không có token nào trong biến môi trường. Bot không thể khởi động.")
         bot_ready = True
         return
-    
-    listener_token = GLOBAL_ACCOUNTS[0]["token"]
-    
-    listener_bot = commands.Bot(command_prefix="!слушать", self_bot=True)
-
-    @listener_bot.event
-    async def on_ready():
-        global bot_ready
-        print("-" * 30)
-        print(f"BOT LẮNG NGHE ĐÃ SẴN SÀNG!")
-        print(f"Đăng nhập với tài khoản: {listener_bot.user} (ID: {listener_bot.user.id})")
-        print("Bot này chỉ dùng để nhận diện drop, các hành động khác sẽ được thực hiện qua HTTP.")
-        print("-" * 30)
-        bot_ready = True
 
-    @listener_bot.event
-    async def on_message(message):
-        if message.author.id != KARUTA_ID or "is dropping 3 cards!" not in message.content:
+    listener_pool = ListenerPool(GLOBAL_ACCOUNTS[:LISTENER_ACCOUNTS])
+    log.info("Khởi động %d kết nối lắng nghe.", len(listener_pool.shards), extra={"count": len(listener_pool.shards)})
+    await listener_pool.run()
+    # Mọi kết nối đều đã dừng hẳn: vẫn cho vòng gửi 'kd' chạy
+    bot_ready = True
+
+# --- CHẾ ĐỘ NHIỀU TIẾN TRÌNH (KD_WORKERS) ---
+# KD_WORKERS > 0: tiến trình chính (supervisor) chạy web + bot lắng nghe, việc gửi 'kd' và thả reaction
+# chia cho N tiến trình worker, mỗi worker có event loop và pool HTTP riêng. Worker đọc cấu hình từ SQLite
+# dùng chung và ghi trạng thái vào bảng worker_status để dashboard gộp lại.
+KD_WORKERS = int(os.getenv("KD_WORKERS", "0"))
+WORKER_POLL_SECONDS = 1.0 # Chu kỳ worker kiểm tra version cấu hình và ghi trạng thái
+WORKER_STALE_SECONDS = 10 # Worker không ghi trạng thái quá lâu thì coi như treo
+worker_supervisor = None # Chỉ có ở tiến trình chính khi bật chế độ worker
+worker_index = None # Chỉ có ở tiến trình worker
+
+def panel_worker(panel_id, count):
+    """Worker phụ trách panel. Dùng crc32 vì hash() của Python khác nhau giữa các tiến trình."""
+    return zlib.crc32(str(panel_id).encode()) % count
+
+class WorkerSupervisor:
+    """Khởi động, theo dõi và khởi động lại các tiến trình worker; chuyển drop tới worker phụ trách panel."""
+
+    def __init__(self, count):
+        self.count = count
+        self._ctx = multiprocessing.get_context("spawn") # Không fork tiến trình đang có luồng
+        self.processes = [None] * count
+        self.inboxes = [None] * count
+        self.restarts = [0] * count
+        self._rows = {} # worker_id -> dòng worker_status gần nhất, monitor() cập nhật
+        # Số đếm của các tiến trình worker đã chết, để tổng trên /metrics không bị tụt khi worker khởi động lại
+        self._retired = {"kd_sends": {}, "reactions": {}}
+
+    def start_worker(self, index):
+        inbox = self._ctx.Queue(maxsize=10000)
+        proc = self._ctx.Process(target=worker_main, args=(index, self.count, inbox, is_kd_loop_enabled),
+                                 name=f"kd-worker-{index}", daemon=True)
+        proc.start()
+        self.inboxes[index] = inbox
+        self.processes[index] = proc
+        log.info("Khởi động worker #%d (pid %d)", index, proc.pid, extra={"count": self.count})
+
+    def start(self):
+        panel_store.clear_worker_status()
+        for index in range(self.count):
+            self.start_worker(index)
+
+    def send(self, index, kind, data):
+        try:
+            self.inboxes[index].put_nowait((kind, data))
+        except queue.Full:
+            log.warning("Hàng đợi của worker #%d đầy, bỏ qua %s", index, kind)
+
+    def broadcast(self, kind, data):
+        for index in range(self.count):
+            self.send(index, kind, data)
+
+    def forward_drop(self, panel, message, trace):
+        """Chuyển drop sang worker phụ trách panel, worker sẽ thả reaction.
+
+        Gửi kèm panel từ bản chụp hiện tại của tiến trình chính: bản cấu hình của worker chỉ cập nhật sau khi
+        SQLite được ghi (có debounce) và worker đọc lại, nên có thể chưa có panel mới hoặc còn token cũ.
+        """
+        self.send(panel_worker(panel.get("id"), self.count), "drop",
+                  {"panel": panel, "channel_id": message.channel.id, "message_id": message.id, "trace": trace})
+
+    def statuses(self):
+        rows = self._rows
+        now = time.time()
+        result = []
+        for index, proc in enumerate(self.processes):
+            row = rows.get(index, {})
+            alive = proc is not None and proc.is_alive() and now - row.get("updated_at", now) < WORKER_STALE_SECONDS
+            result.append({**row, "worker_id": index, "pid": proc.pid if proc else None, "alive": alive,
+                           "restarts": self.restarts[index]})
+        return result
+
+    async def monitor(self):
+        """Khởi động lại worker đã chết, đẩy trạng thái mới tới dashboard khi worker cập nhật."""
+        global sender_heartbeat
+        last_seen = None
+        while True:
+            await asyncio.sleep(WORKER_POLL_SECONDS)
+            sender_heartbeat = time.monotonic()
+            for index, proc in enumerate(self.processes):
+                if proc is not None and not proc.is_alive():
+                    log.error("Worker #%d (pid %d) đã dừng với mã %s, khởi động lại", index, proc.pid, proc.exitcode)
+                    self.restarts[index] += 1
+                    self._retire_counters(index, proc.pid)
+                    self.start_worker(index)
+            rows = await asyncio.to_thread(panel_store.read_worker_status)
+            self._rows = {row["worker_id"]: row for row in rows}
+            seen = tuple(row["status"].get("next_fire_at") for row in rows)
+            if seen != last_seen:
+                last_seen = seen
+                publish_status()
+
+    def _retire_counters(self, index, pid):
+        row = self._rows.get(index)
+        if row is None or row.get("pid") != pid:
             return
+        for key, totals in self._retired.items():
+            for status, value in row.get(key, {}).items():
+                totals[status] = totals.get(status, 0) + value
+
+    def counter_totals(self, key):
+        """{mã HTTP: số lần} của bộ đếm `key` cộng dồn trên mọi worker, kể cả các lần chạy trước khi khởi động lại."""
+        totals = dict(self._retired[key])
+        for index, proc in enumerate(self.processes):
+            row = self._rows.get(index)
+            # Dòng của tiến trình cũ còn nằm trong bảng tới khi worker mới ghi đè: đã tính vào _retired
+            if row is None or proc is None or row.get("pid") != proc.pid:
+                continue
+            for status, value in row.get(key, {}).items():
+                totals[status] = totals.get(status, 0) + value
+        return totals
+
+    def stop(self):
+        for proc in self.processes:
+            if proc is not None and proc.is_alive():
+                proc.terminate()
+        for proc in self.processes:
+            if proc is not None:
+                proc.join(timeout=5)
+
+def merged_worker_status():
+    """Gộp trạng thái các worker thành một: lượt gửi gần nhất là của worker sắp tới lượt sớm nhất."""
+    statuses = worker_supervisor.statuses()
+    rows = [row for row in statuses if row.get("status")]
+    upcoming = [row["status"] for row in rows if row["status"].get("next_fire_at") is not None]
+    first = min(upcoming, key=lambda st: st["next_fire_at"]) if upcoming else {}
+    next_fire_at = first.get("next_fire_at")
+    return {
+        "bot_ready": bot_ready,
+        "current_drop_slot": first.get("current_drop_slot", 0),
+        "next_panel_id": first.get("next_panel_id"),
+        "is_kd_loop_enabled": is_kd_loop_enabled,
+        "next_fire_at": next_fire_at,
+        "seconds_until_next": max(0.0, next_fire_at - time.time()) if next_fire_at else None,
+        "kd_ticks": max((row["status"].get("kd_ticks", 0) for row in rows), default=0),
+        "wheel_position": first.get("wheel_position", 0),
+        "server_time": time.time(),
+        "total_panels": len(panel_state.panels),
+        "config_version": panel_state.version,
+        "workers_alive": sum(1 for row in statuses if row["alive"]),
+    }
 
-        found_panel = None
-        for p in panels:
-            if p.get("channel_id") == str(message.channel.id):
-                found_panel = p
-                break
-        
-        if found_panel:
-            print(f"Phát hiện drop trong kênh {message.channel.id} (Panel: '{found_panel.get('name')}')")
-            asyncio.create_task(handle_reactions(found_panel, message))
+def _read_worker_inbox(inbox):
+    """Luồng đọc hàng đợi của worker, chuyển từng thông điệp vào event loop."""
+    while True:
+        kind, data = inbox.get()
+        main_loop.call_soon_threadsafe(_handle_worker_message, kind, data)
+
+def _handle_worker_message(kind, data):
+    global is_kd_loop_enabled
+    if kind == "drop":
+        message = SimpleNamespace(id=data["message_id"], channel=SimpleNamespace(id=data["channel_id"]))
+        asyncio.create_task(handle_reactions(data["panel"], message, data["trace"]))
+    elif kind == "kd_enabled":
+        is_kd_loop_enabled = data
+        kd_scheduler.set_enabled(data)
+
+def apply_worker_panels(all_panels, index, count):
+    """Giữ lại phần panels của worker này. Gọi trên event loop của worker."""
+    with panels_lock:
+        state = publish_panels([p for p in all_panels if panel_worker(p.get("id"), count) == index])
+    log.info("Worker #%d phụ trách %d panel", index, len(state.panels), extra={"count": len(state.panels)})
+
+def worker_status_data():
+    return {
+        "status": status_payload(),
+        "panels": len(panel_state.panels),
+        "kd_sends": {k[0]: v for k, v in KD_SENDS.snapshot().items()},
+        "reactions": {k[0]: v for k, v in REACTIONS.snapshot().items()},
+        "drop_end_to_end": drop_latency.summary().get("end_to_end", {"count": 0}),
+        "rss_bytes": process_rss_bytes(),
+        "loop_lag": loop_monitor.summary(),
+    }
 
+async def run_worker(index, count, inbox, kd_enabled):
+    global main_loop, bot_ready, is_kd_loop_enabled, worker_index
+    main_loop = asyncio.get_running_loop()
+    worker_index = index
+    is_kd_loop_enabled = kd_enabled
+    bot_ready = True # Bot lắng nghe chạy ở tiến trình chính
+    parent = os.getppid()
+    store = SQLitePanelStore(os.getenv("PANEL_DB_PATH", "panels.db"))
+    version = store.version()
+    apply_worker_panels(store.load(), index, count)
+    # Neo cả ô lẫn số vòng theo giờ thật: worker khởi động lại vẫn giữ pha và slot kế tiếp của từng panel
+    kd_wheel.tick = int(time.time() / WHEEL_TICK)
+    threading.Thread(target=_read_worker_inbox, args=(inbox,), name="worker-inbox", daemon=True).start()
+    sender_task = asyncio.create_task(drop_sender_loop(), name='drop_sender_loop')
+    monitor_task = asyncio.create_task(loop_monitor.run(), name='loop_monitor')
     try:
-        await listener_bot.start(listener_token)
-    except discord.errors.LoginFailure:
-        print(f"LỖI ĐĂNG NHẬP NGHIÊM TRỌNG với token của bot lắng nghe. Vui lòng kiểm tra TOKEN đầu tiên trong file .env.")
-        bot_ready = True
-    except Exception as e:
-        print(f"Lỗi không xác định với bot lắng nghe: {e}")
-        bot_ready = True
+        while not sender_task.done():
+            await asyncio.sleep(WORKER_POLL_SECONDS)
+            if os.getppid() != parent:
+                log.error("Tiến trình chính đã dừng, worker #%d thoát", index)
+                return
+            current = await asyncio.to_thread(store.version)
+            if current != version:
+                version = current
+                apply_worker_panels(await asyncio.to_thread(store.load), index, count)
+            await asyncio.to_thread(store.write_worker_status, index, os.getpid(), worker_status_data())
+        sender_task.result()
+    finally:
+        sender_task.cancel()
+        monitor_task.cancel()
+        await close_session()
+        store.close()
+
+def worker_main(index, count, inbox, kd_enabled):
+    """Điểm vào của tiến trình worker."""
+    log_file = os.getenv("LOG_FILE", "kd.log")
+    setup_logging(f"{log_file}.worker{index}" if log_file else "")
+    asyncio.run(run_worker(index, count, inbox, kd_enabled))
+
+# --- ĐẨY SỰ KIỆN TỚI DASHBOARD (SSE) ---
+SSE_HEARTBEAT = 15 # Gửi comment giữ kết nối nếu không có sự kiện trong khoảng này
+
+class EventBroker:
+    """Phát sự kiện Server-Sent Events tới các tab dashboard đang mở. Gọi publish() từ luồng nào cũng được."""
+
+    def __init__(self, max_queue=256):
+        self.max_queue = max_queue
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=self.max_queue)
+        q.dropped = False
+        with self._lock:
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def publish(self, event, data):
+        message = f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                # Client đọc quá chậm: ngắt để trình duyệt tự kết nối lại và nhận snapshot mới
+                q.dropped = True
+                self.unsubscribe(q)
+
+event_broker = EventBroker()
+
+def public_panel(panel):
+    """Bản panel gửi cho dashboard: thay token bằng id tài khoản."""
+    accounts = {}
+    for slot, token in panel.get("accounts", {}).items():
+        accounts[slot] = ACCOUNT_ID_BY_TOKEN.get(token, "unknown") if token else ""
+    return {**panel, "accounts": accounts}
+
+def status_payload():
+    """Trạng thái chung. Dashboard tự đếm ngược từ next_fire_at thay vì hỏi server mỗi giây."""
+    if worker_supervisor is not None:
+        return merged_worker_status()
+    ticks, next_panel = kd_wheel.next_due()
+    next_fire_at = seconds_until_next = None
+    if ticks is not None and kd_scheduler.next_deadline is not None:
+        seconds_until_next = kd_scheduler.seconds_until_next() + ticks * WHEEL_TICK
+        if kd_scheduler.next_fire_at() is not None:
+            next_fire_at = kd_scheduler.next_fire_at() + ticks * WHEEL_TICK
+    return {
+        "bot_ready": bot_ready,
+        "current_drop_slot": kd_wheel.next_slot(ticks) if next_panel else 0, # Slot của panel sắp gửi
+        "next_panel_id": next_panel,
+        "is_kd_loop_enabled": is_kd_loop_enabled,
+        "next_fire_at": next_fire_at,
+        "seconds_until_next": seconds_until_next,
+        "kd_ticks": kd_scheduler.cycles,
+        "wheel_position": kd_wheel.position,
+        "server_time": time.time(),
+        "total_panels": len(panel_state.panels),
+        "config_version": panel_state.version,
+    }
+
+def publish_status():
+    event_broker.publish("status", status_payload())
+
+def publish_panel(panel):
+    event_broker.publish("panel", public_panel(panel))
 
 # --- GIAO DIỆN WEB & API FLASK ---
-app = Flask(__name__)
+# Flask không tự phục vụ /static: route riêng bên dưới gắn version và header cache
+app = Flask(__name__, static_folder=None)
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+def _file_version(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
+
+# Tên file -> version theo nội dung, tính một lần lúc khởi động; URL đổi khi nội dung đổi
+STATIC_VERSIONS = {name: _file_version(os.path.join(STATIC_DIR, name)) for name in ("dashboard.css", "dashboard.js")}
+
+def static_url(name):
+    return f"/static/{name}?v={STATIC_VERSIONS[name]}"
 
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -271,37 +1358,7 @@ HTML_TEMPLATE = """
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Multi-Farm Deep Control</title>
     <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css">
-    <style>
-        :root { --primary-bg: #111; --secondary-bg: #1d1d1d; --panel-bg: #2a2a2a; --border-color: #444; --text-primary: #f0f0f0; --text-secondary: #aaa; --accent-color: #00aaff; --danger-color: #ff4444; }
-        body { font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, "Helvetica Neue", Arial, sans-serif; background-color: var(--primary-bg); color: var(--text-primary); margin: 0; padding: 20px; }
-        .container { max-width: 1800px; margin: 0 auto; }
-        .header { text-align: center; margin-bottom: 30px; }
-        .header h1 { color: var(--accent-color); font-weight: 600; }
-        .status-bar { display: flex; justify-content: space-around; background-color: var(--secondary-bg); padding: 15px; border-radius: 8px; margin-bottom: 20px; flex-wrap: wrap; gap: 15px; }
-        .status-item { text-align: center; }
-        .status-item span { display: block; font-size: 0.9em; color: var(--text-secondary); }
-        .status-item strong { font-size: 1.2em; color: var(--accent-color); }
-        .controls { display: flex; justify-content: center; margin-bottom: 30px; }
-        .btn { background-color: var(--accent-color); color: white; border: none; padding: 10px 20px; border-radius: 5px; cursor: pointer; font-size: 1em; transition: background-color 0.3s; }
-        .btn:hover { background-color: #0088cc; }
-        .btn-danger { background-color: var(--danger-color); }
-        .btn-danger:hover { background-color: #cc3333; }
-        .farm-grid { display: grid; grid-template-columns: repeat(auto-fit, minmax(380px, 1fr)); gap: 20px; }
-        .panel { background-color: var(--secondary-bg); border: 1px solid var(--border-color); border-radius: 8px; padding: 20px; position: relative; }
-        .panel-header { display: flex; justify-content: space-between; align-items: center; margin-bottom: 20px; border-bottom: 1px solid var(--border-color); padding-bottom: 10px; }
-        .panel-header h3 { margin: 0; font-size: 1.2em; }
-        .input-group { margin-bottom: 15px; }
-        .input-group label { display: block; color: var(--text-secondary); margin-bottom: 5px; font-size: 0.9em; }
-        .input-group input, .input-group select { width: 100%; background-color: var(--primary-bg); border: 1px solid var(--border-color); color: var(--text-primary); padding: 8px; border-radius: 5px; box-sizing: border-box; }
-        .account-slots { display: grid; grid-template-columns: 1fr; gap: 15px; }
-        .server-name-display { 
-            font-size: 0.8em; 
-            color: var(--text-secondary); 
-            margin-top: 5px; 
-            display: block;
-            height: 1.2em;
-        }
-    </style>
+    <link rel="stylesheet" href="{{ css_url }}">
 </head>
 <body>
     <div class="container">
@@ -322,375 +1379,765 @@ HTML_TEMPLATE = """
             <button id="toggle-kd-btn" class="btn" style="margin-left: 15px;"></button>
         </div>    
 
+        <div class="toolbar">
+            <input type="search" id="panel-search" placeholder="Tìm theo tên, Channel ID hoặc tên server...">
+            <select id="panel-filter">
+                <option value="all">Tất cả panel</option>
+                <option value="ready">Đủ kênh và tài khoản</option>
+                <option value="missing-accounts">Thiếu tài khoản</option>
+                <option value="no-channel">Chưa có kênh</option>
+            </select>
+            <select id="page-size">
+                <option value="24">24 / trang</option>
+                <option value="48" selected>48 / trang</option>
+                <option value="96">96 / trang</option>
+            </select>
+            <div class="pager">
+                <button id="prev-page" class="btn btn-sm"><i class="fas fa-chevron-left"></i></button>
+                <span id="page-info"></span>
+                <button id="next-page" class="btn btn-sm"><i class="fas fa-chevron-right"></i></button>
+            </div>
+        </div>
+
         <div id="farm-grid" class="farm-grid">
         </div>
     </div>
 
-<script>
-document.addEventListener('DOMContentLoaded', function () {
-    const API_ENDPOINT = '/api/panels';
-
-    async function apiCall(method, data = null) {
-        try {
-            const options = {
-                method: method,
-                headers: { 'Content-Type': 'application/json' },
-            };
-            if (data) options.body = JSON.stringify(data);
-            const response = await fetch(API_ENDPOINT, options);
-            if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
-            return await response.json();
-        } catch (error) {
-            console.error('API call failed:', error);
-            alert('Thao tác thất bại. Vui lòng kiểm tra console log.');
-            return null;
-        }
-    }
-    
-    function renderPanels(panels) {
-        const grid = document.getElementById('farm-grid');
-        grid.innerHTML = '';
-        if (!panels) return;
-    
-        const usedTokens = new Set();
-        panels.forEach(p => {
-            Object.values(p.accounts).forEach(token => {
-                if (token) {
-                    usedTokens.add(token);
-                }
-            });
-        });
-    
-        panels.forEach(panel => {
-            const panelEl = document.createElement('div');
-            panelEl.className = 'panel';
-            panelEl.dataset.id = panel.id;
-    
-            let accountSlotsHTML = '';
-            
-            for (let i = 1; i <= 3; i++) {
-                const slotKey = `slot_${i}`;
-                const currentTokenForSlot = panel.accounts[slotKey] || '';
-                
-                let uniqueAccountOptions = '<option value="">-- Chọn tài khoản --</option>';
-                
-                {{ GLOBAL_ACCOUNTS_JSON | safe }}.forEach(acc => {
-                    if (!usedTokens.has(acc.token) || acc.token === currentTokenForSlot) {
-                        uniqueAccountOptions += `<option value="${acc.token}">${acc.name}</option>`;
-                    }
-                });
-    
-                accountSlotsHTML += `
-                    <div class="input-group">
-                        <label>Slot ${i}</label>
-                        <select class="account-selector" data-slot="${slotKey}">
-                            ${uniqueAccountOptions}
-                        </select>
-                    </div>
-                `;
-            }
-    
-            panelEl.innerHTML = `
-                <div class="panel-header">
-                    <h3 contenteditable="true" class="panel-name">${panel.name}</h3>
-                    <button class="btn btn-danger btn-sm delete-panel-btn"><i class="fas fa-trash"></i></button>
-                </div>
-                <div class="input-group">
-                    <label>Channel ID</label>
-                    <input type="text" class="channel-id-input" value="${panel.channel_id || ''}">
-                    <small class="server-name-display">${panel.server_name || '(Tên server sẽ hiện ở đây)'}</small>
-                </div>
-                <div class="account-slots">${accountSlotsHTML}</div>
-            `;
-            grid.appendChild(panelEl);
-            
-            for (let i = 1; i <= 3; i++) {
-                const slotKey = `slot_${i}`;
-                const selectedToken = panel.accounts[slotKey] || '';
-                panelEl.querySelector(`select[data-slot="${slotKey}"]`).value = selectedToken;
-            }
-        });
-    }
-    
-    async function updateStatus() {
-        try {
-            const response = await fetch('/status');
-            const data = await response.json();
-            
-            document.getElementById('bot-status').textContent = data.bot_ready ? 'Đang hoạt động' : 'Đang kết nối...';
-            document.getElementById('total-panels').textContent = data.panels.length;
-            document.getElementById('next-slot').textContent = `Slot ${data.current_drop_slot + 1}`;
-            
-            let countdown = data.countdown;
-            let timeString = new Date(countdown * 1000).toISOString().substr(11, 8);
-            document.getElementById('countdown').textContent = timeString;
-
-            const toggleBtn = document.getElementById('toggle-kd-btn');
-            if (toggleBtn) {
-                if (data.is_kd_loop_enabled) {
-                    toggleBtn.textContent = 'TẮT VÒNG LẶP KD';
-                    toggleBtn.classList.remove('btn-danger');
-                    document.getElementById('next-slot').style.color = 'var(--accent-color)';
-                } else {
-                    toggleBtn.textContent = 'BẬT VÒNG LẶP KD';
-                    toggleBtn.classList.add('btn-danger');
-                    document.getElementById('next-slot').style.color = 'var(--danger-color)';
-                }
-            }
-        } catch (e) {
-            console.error("Error updating status:", e);
-        }
-    }
-
-    async function fetchAndRenderPanels() {
-        const response = await fetch('/status');
-        const data = await response.json();
-        renderPanels(data.panels);
-    }
-    
-    document.getElementById('add-panel-btn').addEventListener('click', async () => {
-        const name = prompt('Nhập tên cho panel mới:', 'Farm Server Mới');
-        if (name) {
-            await apiCall('POST', { name });
-            fetchAndRenderPanels();
-        }
-    });
-
-    document.getElementById('farm-grid').addEventListener('click', async (e) => {
-        if (e.target.closest('.delete-panel-btn')) {
-            const panelEl = e.target.closest('.panel');
-            const panelId = panelEl.dataset.id;
-            if (confirm(`Bạn có chắc muốn xóa panel "${panelEl.querySelector('.panel-name').textContent}"?`)) {
-                await apiCall('DELETE', { id: panelId });
-                fetchAndRenderPanels();
-            }
-        }
-    });
-    
-    document.getElementById('farm-grid').addEventListener('change', async (e) => {
-        const panelEl = e.target.closest('.panel');
-        if (!panelEl) return;
-        const panelId = panelEl.dataset.id;
-    
-        const payload = { id: panelId, update: {} };
-    
-        if (e.target.classList.contains('channel-id-input')) {
-            payload.update.channel_id = e.target.value.trim();
-            
-            // Gửi API call để LƯU và LẤY tên server
-            const updatedPanel = await apiCall('PUT', payload);
-    
-            // Cập nhật tên server ngay lập tức
-            if (updatedPanel) {
-                const serverNameEl = panelEl.querySelector('.server-name-display');
-                if (serverNameEl) {
-                    serverNameEl.textContent = updatedPanel.server_name || '(Không tìm thấy server)';
-                }
-            }
-        } else if (e.target.classList.contains('account-selector')) {
-            const slot = e.target.dataset.slot;
-            const token = e.target.value;
-            payload.update.accounts = { [slot]: token };
-
-            // BƯỚC 1: Gửi API call để LƯU lựa chọn mới
-            await apiCall('PUT', payload);
-
-            // BƯỚC 2: SAU KHI LƯU, vẽ lại tất cả các panel để cập nhật giao diện và danh sách ẩn
-            fetchAndRenderPanels();
-        }
-    });
-    
-    document.getElementById('farm-grid').addEventListener('blur', async (e) => {
-        if (e.target.classList.contains('panel-name')) {
-             const panelEl = e.target.closest('.panel');
-             const panelId = panelEl.dataset.id;
-             const newName = e.target.textContent.trim();
-             await apiCall('PUT', { id: panelId, update: { name: newName } });
-        }
-    }, true);
-
-    const toggleBtn = document.getElementById('toggle-kd-btn');
-    if (toggleBtn) {
-        toggleBtn.addEventListener('click', async () => {
-            await fetch('/api/toggle_kd', { method: 'POST' });
-            updateStatus();
-        });
-    }
-
-    setInterval(updateStatus, 1000); // Update countdown every second
-    fetchAndRenderPanels(); 
-});
-</script>
+<script src="{{ js_url }}"></script>
 </body>
 </html>
 """
 
+# Trang chỉ phụ thuộc version của các file tĩnh nên được dựng đúng một lần
+COMPRESS_MIN_BYTES = 512 # Body nhỏ hơn thì nén không đáng
+# ETag của dữ liệu cấu hình là BOOT_ID-version: version chỉ tăng trong một lần chạy,
+# BOOT_ID đổi mỗi lần khởi động để ETag cũ không khớp nhầm
+BOOT_ID = os.urandom(4).hex()
+
+class EncodedBody:
+    """Body đã serialize cùng các bản nén, mỗi kiểu nén chỉ tính một lần rồi dùng lại."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._encoded = {}
+
+    def get(self, encoding):
+        data = self._encoded.get(encoding)
+        if data is None:
+            if encoding == "br":
+                data = brotli.compress(self.raw, quality=5)
+            else:
+                data = gzip.compress(self.raw, compresslevel=6)
+            self._encoded[encoding] = data
+        return data
+
+def pick_encoding(size):
+    """Chọn kiểu nén theo Accept-Encoding của client, None nếu không nén."""
+    if size < COMPRESS_MIN_BYTES:
+        return None
+    return request.accept_encodings.best_match(["br", "gzip"] if brotli is not None else ["gzip"])
+
+def cached_response(body, mimetype, etag):
+    """Trả body (bytes hoặc EncodedBody) kèm ETag, nén nếu client hỗ trợ.
+
+    Trình duyệt luôn hỏi lại (no-cache) và nhận 304 nếu không đổi.
+    """
+    response = Response(mimetype=mimetype)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    response.vary.add("Accept-Encoding")
+    if request.if_none_match.contains_weak(etag):
+        response.status_code = 304
+        return response
+    if not isinstance(body, EncodedBody):
+        body = EncodedBody(body)
+    encoding = pick_encoding(len(body.raw))
+    if encoding:
+        response.set_data(body.get(encoding))
+        response.content_encoding = encoding
+    else:
+        response.set_data(body.raw)
+    return response
+
+DASHBOARD_PAGE = EncodedBody(app.jinja_env.from_string(HTML_TEMPLATE).render(
+    css_url=static_url("dashboard.css"), js_url=static_url("dashboard.js")).encode())
+DASHBOARD_ETAG = hashlib.sha1(DASHBOARD_PAGE.raw).hexdigest()[:16]
+ACCOUNTS_BODY = EncodedBody(json.dumps([{"id": acc["id"], "name": acc["name"]} for acc in GLOBAL_ACCOUNTS],
+                                       ensure_ascii=False).encode())
+ACCOUNTS_ETAG = hashlib.sha1(ACCOUNTS_BODY.raw).hexdigest()[:16]
+
+_panels_bodies = {} # public -> (version, EncodedBody) của danh sách panel đã serialize
+
+def panels_body(state, public=False):
+    """JSON danh sách panel của một bản chụp; mỗi version cấu hình chỉ serialize (và nén) một lần.
+
+    public=True thay token bằng id tài khoản, dùng cho những gì trả về trình duyệt.
+    """
+    version, body = _panels_bodies.get(public, (None, None))
+    if version != state.version:
+        panels = [public_panel(p) for p in state.panels] if public else list(state.panels)
+        body = EncodedBody(json.dumps(panels, ensure_ascii=False).encode())
+        _panels_bodies[public] = (state.version, body)
+    return body
+
+PANEL_QUERY_PARAMS = ("name", "channel_id", "guild_id", "account", "unassigned", "limit", "cursor")
+PANEL_PAGE_DEFAULT = 100
+PANEL_PAGE_MAX = 1000
+
+def encode_cursor(position, panel_id, next_id):
+    raw = json.dumps([position, panel_id, next_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def cursor_start(index, cursor):
+    """Vị trí bắt đầu trang sau cursor. Cursor nhớ panel cuối trang trước và panel kế tiếp nó:
+    panel cuối còn thì đi tiếp sau vị trí mới của nó, đã bị xóa thì bắt đầu từ panel kế tiếp,
+    cả hai cùng bị xóa mới dùng vị trí cũ. Nhờ vậy thêm/xóa panel giữa hai trang không làm lặp hay sót panel.
+    """
+    try:
+        position, panel_id, next_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        position = int(position)
+    except (ValueError, TypeError):
+        return None
+    current = index.positions.get(panel_id)
+    if current is not None:
+        return current + 1
+    following = index.positions.get(next_id)
+    return following if following is not None else position + 1
+
+def query_panels(state, args):
+    """Một trang panel theo bộ lọc trong query string, dùng chỉ mục của bản chụp thay vì duyệt danh sách."""
+    index = state.index()
+    limit = max(1, min(args.get("limit", PANEL_PAGE_DEFAULT, type=int), PANEL_PAGE_MAX))
+    start = 0
+    if args.get("cursor"):
+        start = cursor_start(index, args["cursor"])
+        if start is None:
+            return jsonify({"error": "Cursor không hợp lệ"}), 400
+    matches = index.query(name=args.get("name", "").strip(), channel_id=args.get("channel_id", "").strip(),
+                          guild_id=args.get("guild_id", "").strip(), account=args.get("account", "").strip(),
+                          unassigned=args.get("unassigned", "").strip())
+    if matches is None:
+        total = len(state.panels)
+        page = list(range(start, min(start + limit, total)))
+        has_more = start + limit < total
+        following = start + limit
+    else:
+        total = len(matches)
+        first = bisect.bisect_left(matches, start)
+        page = matches[first:first + limit]
+        has_more = first + limit < total
+        following = matches[first + limit] if has_more else None
+    items = [state.panels[i] for i in page]
+    next_cursor = None
+    if has_more and page:
+        next_cursor = encode_cursor(page[-1], items[-1].get("id"), state.panels[following].get("id"))
+    response = jsonify({"items": items, "next_cursor": next_cursor, "total": total, "version": state.version})
+    response.headers["X-Config-Version"] = str(state.version)
+    return response
+
+# Trường tính theo đồng hồ (đổi ở mọi request) hoặc đổi theo từng nhịp bánh xe dù không có gì được gửi:
+# không đưa vào ETag của /status để các lần hỏi liên tiếp vẫn nhận 304
+STATUS_VOLATILE = ("server_time", "seconds_until_next", "kd_ticks", "wheel_position")
+
 @app.route("/")
 def index():
-    global_accounts_json = json.dumps([{"name": acc["name"], "token": acc["token"]} for acc in GLOBAL_ACCOUNTS])
-    return render_template_string(HTML_TEMPLATE, GLOBAL_ACCOUNTS_JSON=global_accounts_json)
+    return cached_response(DASHBOARD_PAGE, "text/html", DASHBOARD_ETAG)
+
+@app.route("/static/<path:filename>")
+def static_files(filename):
+    """File tĩnh: URL có đúng version thì cache lâu dài, nếu không thì bắt trình duyệt kiểm tra lại bằng ETag."""
+    versioned = filename in STATIC_VERSIONS and request.args.get("v") == STATIC_VERSIONS[filename]
+    response = send_from_directory(STATIC_DIR, filename, max_age=STATIC_MAX_AGE if versioned else 0)
+    if versioned:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+@app.route("/api/accounts")
+def accounts():
+    """Danh sách tài khoản (id, tên) cho dashboard, không có token."""
+    return cached_response(ACCOUNTS_BODY, "application/json", ACCOUNTS_ETAG)
+
+BATCH_MAX_OPERATIONS = 5000
+
+def new_panel_id(existing):
+    """Id panel mới, không trùng với existing kể cả khi tạo nhiều panel trong cùng một giây."""
+    while True:
+        panel_id = f"panel_{int(time.time())}_{os.urandom(3).hex()}"
+        if panel_id not in existing:
+            return panel_id
+
+def make_panel(name, existing):
+    return {
+        "id": new_panel_id(existing),
+        "name": name,
+        "channel_id": "",
+        "server_name": "",
+        "accounts": {f"slot_{i}": "" for i in range(1, 4)}
+    }
+
+def apply_panel_update(panel, update_data):
+    """Áp dụng các trường name/accounts/channel_id lên bản sao panel. Trả về channel_id mới nếu có đổi kênh."""
+    if 'name' in update_data: panel['name'] = update_data['name']
+
+    if 'accounts' in update_data:
+        for slot, account in update_data['accounts'].items():
+            # Dashboard gửi id tài khoản; vẫn nhận token thô cho các công cụ cũ
+            panel['accounts'][slot] = TOKEN_BY_ACCOUNT_ID.get(account, account)
+
+    if 'channel_id' in update_data:
+        new_channel_id = update_data['channel_id'].strip()
+        panel['channel_id'] = new_channel_id
+        return new_channel_id
+    return None
+
+def validate_accounts(accounts, allow_unknown=False):
+    """Kiểm tra accounts {slot: id tài khoản hoặc token}. Trả về thông báo lỗi hoặc None.
+
+    Id dạng acc_N phải có trong TOKENS, nếu không sẽ bị lưu như một token và gửi đi làm Authorization.
+    allow_unknown cho phép "unknown" (bản xuất không kèm token) để giữ nguyên token đang có.
+    """
+    if not isinstance(accounts, dict):
+        return "accounts không hợp lệ"
+    for slot, account in accounts.items():
+        if slot not in SLOT_KEYS or not isinstance(account, str):
+            return "accounts không hợp lệ"
+        if allow_unknown and account == "unknown":
+            continue
+        if account.startswith("acc_") and account not in TOKEN_BY_ACCOUNT_ID:
+            return f"Không có tài khoản {account} ({slot})"
+    return None
+
+def validate_batch_operation(op, working):
+    """Trả về thông báo lỗi nếu thao tác không hợp lệ với trạng thái hiện tại của lô, None nếu hợp lệ."""
+    if not isinstance(op, dict):
+        return "Thao tác phải là object"
+    kind = op.get("op")
+    if kind == "create":
+        if not isinstance(op.get("name"), str) or not op["name"].strip():
+            return "Tên là bắt buộc"
+        if "id" in op and (not isinstance(op["id"], str) or not op["id"].strip()):
+            return "id không hợp lệ"
+        if op.get("id") in working:
+            return "id đã tồn tại"
+        fields = op
+    elif kind in ("update", "delete"):
+        if op.get("id") not in working:
+            return "Không tìm thấy panel"
+        if kind == "delete":
+            return None
+        fields = op.get("update")
+        if not isinstance(fields, dict):
+            return "Thiếu update"
+        if "name" in fields and (not isinstance(fields["name"], str) or not fields["name"].strip()):
+            return "Tên không hợp lệ"
+    else:
+        return "op phải là create, update hoặc delete"
+    if "channel_id" in fields and not isinstance(fields["channel_id"], str):
+        return "channel_id phải là chuỗi"
+    return validate_accounts(fields.get("accounts", {}))
 
 @app.route("/api/panels", methods=['GET', 'POST', 'PUT', 'DELETE'])
 def handle_panels():
-    global panels
     if request.method == 'GET':
-        return jsonify(panels)
+        state = panel_state
+        if any(key in request.args for key in PANEL_QUERY_PARAMS):
+            # Có tham số: trả từng trang {items, next_cursor}; không có thì giữ dạng danh sách đầy đủ như cũ
+            return query_panels(state, request.args)
+        response = cached_response(panels_body(state), "application/json", f"{BOOT_ID}-{state.version}")
+        response.headers["X-Config-Version"] = str(state.version)
+        return response
 
     elif request.method == 'POST':
         data = request.get_json()
         name = data.get('name')
         if not name: return jsonify({"error": "Tên là bắt buộc"}), 400
-        new_panel = {
-            "id": f"panel_{int(time.time())}",
-            "name": name,
-            "channel_id": "",
-            "server_name": "",
-            "accounts": {f"slot_{i}": "" for i in range(1, 4)}
-        }
-        panels.append(new_panel)
-        save_panels()
-        return jsonify(new_panel), 201
+        with panels_lock:
+            new_panel = make_panel(name, panel_state.by_id)
+            new_panel["kd_offset"] = kd_wheel.pick_offset() # Pha riêng ở ô còn trống nhất
+            publish_panels(panel_state.panels + (new_panel,))
+        save_panels(upserted=[new_panel["id"]])
+        publish_panel(new_panel)
+        publish_status()
+        return jsonify(public_panel(new_panel)), 201
 
     elif request.method == 'PUT':
         data = request.get_json()
         panel_id = data.get('id')
         update_data = data.get('update')
-        panel_to_update = next((p for p in panels if p.get('id') == panel_id), None)
-        if not panel_to_update: return jsonify({"error": "Không tìm thấy panel"}), 404
-
-        if 'name' in update_data: panel_to_update['name'] = update_data['name']
-
-        if 'channel_id' in update_data:
-            new_channel_id = update_data['channel_id'].strip()
-            panel_to_update['channel_id'] = new_channel_id
-            server_name = get_server_name_from_channel(new_channel_id)
-            panel_to_update['server_name'] = server_name
-
-        if 'accounts' in update_data:
-            for slot, token in update_data['accounts'].items():
-                panel_to_update['accounts'][slot] = token
-
-        save_panels()
-        return jsonify(panel_to_update)
+        with panels_lock:
+            state = panel_state
+            if panel_id not in state.by_id: return jsonify({"error": "Không tìm thấy panel"}), 404
+            error = validate_accounts(update_data.get('accounts', {}))
+            if error: return jsonify({"error": error}), 400
+            panel_to_update = edit_panel(state.by_id[panel_id])
+            new_channel_id = apply_panel_update(panel_to_update, update_data)
+            if new_channel_id is not None:
+                # Trả về ngay; tên server được tra ở nền và đẩy qua SSE
+                schedule_server_name(panel_to_update, new_channel_id)
+            replace_panel(state, panel_to_update)
+
+        save_panels(upserted=[panel_id])
+        publish_panel(panel_to_update)
+        return jsonify(public_panel(panel_to_update))
 
     elif request.method == 'DELETE':
         data = request.get_json()
         panel_id = data.get('id')
-        panels = [p for p in panels if p.get('id') != panel_id]
-        save_panels()
+        with panels_lock:
+            publish_panels([p for p in panel_state.panels if p.get('id') != panel_id])
+        save_panels(deleted=[panel_id])
+        event_broker.publish("panel_deleted", {"id": panel_id})
+        publish_status()
         return jsonify({"message": "Đã xóa panel"}), 200
         
+@app.route("/api/panels/batch", methods=['POST'])
+def batch_panels():
+    """Áp dụng nhiều thao tác tạo/sửa/xóa panel cùng lúc: hoặc tất cả, hoặc không gì cả.
+
+    Body: {"operations": [{"op": "create", "name", "id"?, "channel_id"?, "accounts"?}, {"op": "update", "id", "update"},
+    {"op": "delete", "id"}]}. Thao tác sau thấy kết quả của thao tác trước, nên có thể tạo panel với id tự chọn
+    rồi sửa/xóa nó trong cùng lô. Cả lô chỉ đăng một bản chụp và lưu một lần; tên server của các kênh mới
+    được tra song song (có giới hạn) ở nền.
+    """
+    data = request.get_json(silent=True)
+    operations = data.get("operations") if isinstance(data, dict) else data
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"error": "Cần danh sách operations"}), 400
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return jsonify({"error": f"Tối đa {BATCH_MAX_OPERATIONS} thao tác mỗi lô"}), 400
+
+    with panels_lock:
+        state = panel_state
+        working = dict(state.by_id) # id -> panel sau các thao tác trước trong lô
+        created, updated, deleted, lookups, errors, results = [], set(), [], {}, [], []
+        for i, op in enumerate(operations):
+            error = validate_batch_operation(op, working)
+            if error:
+                errors.append({"index": i, "error": error})
+                continue
+            kind = op["op"]
+            if kind == "delete":
+                del working[op["id"]]
+                if op["id"] in created:
+                    created.remove(op["id"]) # Tạo rồi xóa trong cùng lô: không có gì để lưu
+                else:
+                    deleted.append(op["id"])
+                updated.discard(op["id"])
+                lookups.pop(op["id"], None)
+                results.append({"op": kind, "id": op["id"]})
+                continue
+            if kind == "create":
+                panel = make_panel(op["name"].strip(), working)
+                if op.get("id"):
+                    panel["id"] = op["id"].strip()
+                created.append(panel["id"])
+                update = {k: op[k] for k in ("channel_id", "accounts") if k in op}
+            else:
+                panel = edit_panel(working[op["id"]])
+                if panel["id"] not in created:
+                    updated.add(panel["id"])
+                update = op["update"]
+            new_channel_id = apply_panel_update(panel, update)
+            if new_channel_id is not None:
+                lookups.pop(panel["id"], None)
+                if not new_channel_id:
+                    panel["guild_id"], panel["server_name"] = "", ""
+                elif prefill_server_name(panel, new_channel_id):
+                    lookups[panel["id"]] = new_channel_id
+            working[panel["id"]] = panel
+            results.append({"op": kind, "id": panel["id"]})
+        if errors:
+            return jsonify({"error": "Lô thao tác không hợp lệ, chưa áp dụng gì", "errors": errors}), 400
+
+        panels = [working[p["id"]] for p in state.panels if p["id"] in working]
+        panels.extend(working[pid] for pid in created)
+        kd_wheel.assign_offsets(panels) # Chỉ panel mới chưa có pha, rải đều theo tải hiện tại
+        publish_panels(panels)
+        version = panel_state.version
+
+    changed = created + sorted(updated)
+    save_panels(upserted=changed, deleted=deleted)
+    if lookups:
+        asyncio.run_coroutine_threadsafe(resolve_panel_server_names(list(lookups.items())), main_loop)
+    for pid in changed:
+        publish_panel(working[pid])
+    for pid in deleted:
+        event_broker.publish("panel_deleted", {"id": pid})
+    publish_status()
+    for result in results:
+        if result["id"] in working:
+            result["panel"] = public_panel(working[result["id"]])
+    return jsonify({"version": version, "results": results})
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "500"))
+IMPORT_MAX_ERRORS = 100 # Số lỗi tối đa trả về, phần còn lại chỉ được đếm
+
+def validate_panel_record(record):
+    """Kiểm tra một dòng NDJSON nhập vào. Trả về thông báo lỗi hoặc None nếu hợp lệ."""
+    if not isinstance(record, dict):
+        return "Mỗi dòng phải là một object"
+    if not isinstance(record.get("name"), str) or not record["name"].strip():
+        return "Tên là bắt buộc"
+    for key in ("id", "channel_id", "server_name", "guild_id"):
+        if key in record and not isinstance(record[key], str):
+            return f"{key} phải là chuỗi"
+    if "id" in record and not record["id"].strip():
+        return "id không được rỗng"
+    offset = record.get("kd_offset")
+    if offset is not None and not (isinstance(offset, int) and 0 <= offset < kd_wheel.size):
+        return "kd_offset không hợp lệ"
+    return validate_accounts(record.get("accounts", {}), allow_unknown=True)
+
+def panel_from_record(record, existing):
+    """Panel đầy đủ từ một bản ghi đã kiểm tra, gộp lên panel cùng id nếu đã có."""
+    current = existing.get(record.get("id"))
+    if current is not None:
+        panel = edit_panel(current)
+    else:
+        panel = make_panel(record["name"], existing)
+        if record.get("id"):
+            panel["id"] = record["id"]
+    panel["name"] = record["name"]
+    for slot, account in record.get("accounts", {}).items():
+        if account == "unknown":
+            continue # Bản xuất không kèm token: giữ nguyên token đang có
+        panel["accounts"][slot] = TOKEN_BY_ACCOUNT_ID.get(account, account)
+    for key in ("channel_id", "server_name", "guild_id"):
+        if key in record:
+            panel[key] = record[key].strip()
+    if record.get("kd_offset") is not None:
+        panel["kd_offset"] = record["kd_offset"]
+    return panel
+
+def apply_import_chunk(records):
+    """Gộp một phần bản ghi vào cấu hình: một bản chụp và một lần đánh dấu lưu cho cả phần. Trả về id các panel."""
+    ids, lookups = [], []
+    with panels_lock:
+        panels = list(panel_state.panels)
+        positions = {p["id"]: i for i, p in enumerate(panels)}
+        existing = dict(panel_state.by_id)
+        for record in records:
+            panel = panel_from_record(record, existing)
+            if panel["channel_id"] and "server_name" not in record and prefill_server_name(panel, panel["channel_id"]):
+                lookups.append((panel["id"], panel["channel_id"]))
+            existing[panel["id"]] = panel
+            if panel["id"] in positions:
+                panels[positions[panel["id"]]] = panel
+            else:
+                positions[panel["id"]] = len(panels)
+                panels.append(panel)
+            ids.append(panel["id"])
+        kd_wheel.assign_offsets(panels) # Panel mới không kèm kd_offset
+        publish_panels(panels)
+    save_panels(upserted=ids)
+    if lookups:
+        asyncio.run_coroutine_threadsafe(resolve_panel_server_names(lookups), main_loop)
+    return ids
+
+def publish_snapshot():
+    """Gửi lại toàn bộ cấu hình cho dashboard, dùng sau các thay đổi lớn thay cho từng sự kiện panel."""
+    event_broker.publish("snapshot", {"status": status_payload(), "panels": [public_panel(p) for p in panel_state.panels]})
+
+@app.route("/api/panels/export")
+def export_panels():
+    """Xuất cấu hình dạng NDJSON (mỗi dòng một panel), stream từ bản chụp hiện tại.
+
+    Mặc định thay token bằng id tài khoản như dashboard; ?tokens=1 để xuất cả token khi cần sao lưu đầy đủ.
+    """
+    state = panel_state
+    include_tokens = request.args.get("tokens") == "1"
+
+    def stream():
+        for panel in state.panels:
+            record = panel if include_tokens else public_panel(panel)
+            yield json.dumps(record, ensure_ascii=False, sort_keys=True) + "\n"
+
+    return Response(stream(), mimetype="application/x-ndjson", headers={
+        "X-Config-Version": str(state.version),
+        "Content-Disposition": "attachment; filename=panels.ndjson",
+    })
+
+@app.route("/api/panels/import", methods=['POST'])
+def import_panels():
+    """Nhập cấu hình NDJSON, đọc body theo dòng và áp dụng từng phần IMPORT_CHUNK_SIZE bản ghi.
+
+    Panel cùng id được cập nhật, id mới được thêm. Dòng lỗi bị bỏ qua và liệt kê trong kết quả.
+    ?mode=replace xóa các panel không có trong file (chỉ khi không có dòng lỗi); ?dry_run=1 chỉ kiểm tra.
+    """
+    replace = request.args.get("mode") == "replace"
+    dry_run = request.args.get("dry_run") == "1"
+    seen = set()
+    chunk, errors = [], []
+    result = {"imported": 0, "created": 0, "updated": 0, "deleted": 0, "invalid": 0}
+    for line_no, line in enumerate(request.stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            error = "JSON không hợp lệ"
+        else:
+            error = validate_panel_record(record)
+        if error:
+            result["invalid"] += 1
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append({"line": line_no, "error": error})
+            continue
+        if record.get("id"):
+            record["id"] = record["id"].strip()
+            known = record["id"] in seen or record["id"] in panel_state.by_id
+            seen.add(record["id"])
+        else:
+            known = False
+        result["updated" if known else "created"] += 1
+        result["imported"] += 1
+        if dry_run:
+            continue
+        chunk.append(record)
+        if len(chunk) >= IMPORT_CHUNK_SIZE:
+            seen.update(apply_import_chunk(chunk))
+            chunk = []
+    if chunk and not dry_run:
+        seen.update(apply_import_chunk(chunk))
+
+    if replace and not errors and not dry_run and result["imported"]:
+        with panels_lock:
+            removed = [p["id"] for p in panel_state.panels if p["id"] not in seen]
+            if removed:
+                publish_panels([p for p in panel_state.panels if p["id"] in seen])
+        if removed:
+            save_panels(deleted=removed)
+        result["deleted"] = len(removed)
+    elif replace and dry_run and not errors:
+        result["deleted"] = sum(1 for pid in panel_state.by_id if pid not in seen)
+
+    if not dry_run and (result["imported"] or result["deleted"]):
+        panel_writer.flush() # Trả về khi cấu hình đã được ghi xong
+        publish_snapshot()
+    result.update({"errors": errors, "version": panel_state.version, "dry_run": dry_run})
+    return jsonify(result), 200 if result["imported"] or not result["invalid"] else 400
+
 @app.route("/status")
 def status():
-    # This part is tricky because the loop is in another thread.
-    # We can add a global variable to track the last send time.
+    """Trạng thái chung (nhỏ). Danh sách panel tách ra /status/panels: khi bánh xe kín panel thì trạng thái đổi
+    mỗi nhịp, gộp chung sẽ phải gửi lại toàn bộ panel ở mỗi lần hỏi."""
+    payload = status_payload()
+    stable = json.dumps({k: v for k, v in payload.items() if k not in STATUS_VOLATILE}, sort_keys=True)
+    etag = f"{BOOT_ID}-{hashlib.sha1(stable.encode()).hexdigest()[:12]}"
+    if request.if_none_match.contains_weak(etag):
+        return cached_response(b"", "application/json", etag)
+    countdown = payload["seconds_until_next"] or 0
+    body = json.dumps({**payload, "countdown": countdown}, ensure_ascii=False).encode()
+    return cached_response(body, "application/json", etag)
+
+@app.route("/status/panels")
+def status_panels():
+    """Danh sách panel (token đã thay bằng id tài khoản); ETag chỉ đổi khi cấu hình đổi (config_version)."""
+    state = panel_state
+    response = cached_response(panels_body(state, public=True), "application/json", f"{BOOT_ID}-{state.version}")
+    response.headers["X-Config-Version"] = str(state.version)
+    return response
+
+@app.route("/metrics")
+def metrics():
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/api/traces/latency")
+def drop_latency_stats():
+    """Phân vị độ trễ (giây) của từng giai đoạn xử lý drop."""
+    return jsonify(drop_latency.summary())
+
+@app.route("/api/traces/loop")
+def loop_lag_stats():
+    """Phân vị độ trễ đánh thức của event loop (giây) và số lần bị chặn."""
+    return jsonify(loop_monitor.summary())
+
+@app.route("/api/traces/recent")
+def recent_traces():
+    limit = max(0, min(request.args.get("limit", 20, type=int), recent_drop_traces.maxlen))
+    return jsonify(list(recent_drop_traces)[-limit:] if limit else [])
+
+@app.route("/api/listeners")
+def listeners():
+    """Trạng thái các kết nối lắng nghe và số server giao cho mỗi kết nối."""
+    return jsonify(listener_pool.status() if listener_pool else [])
+
+@app.route("/api/listeners/memory")
+def listener_memory():
+    """RSS của tiến trình và kích thước cache của các kết nối lắng nghe."""
+    if listener_pool is None:
+        return jsonify({"lean": LISTENER_LEAN, "rss_bytes": process_rss_bytes(), "shards": []})
+    return jsonify(listener_pool.memory_report())
+
+def mask_token(token):
+    return f"{token[:4]}…{token[-4:]}" if len(token) > 12 else "…"
+
+@app.route("/api/dispatch_plan")
+def dispatch_plan():
+    """Kế hoạch gửi 'kd' đang dùng (để gỡ lỗi): từng slot là danh sách (panel, tài khoản, kênh), token đã che."""
+    plan = kd_wheel.plan
+    limit = request.args.get("limit", 100, type=int)
+    slots = {}
+    for slot_key, items in zip(SLOT_KEYS, plan.slots):
+        slots[slot_key] = [
+            {"panel_id": pid, "account_id": ACCOUNT_ID_BY_TOKEN.get(item[0], "unknown"),
+             "token": mask_token(item[0]), "channel_id": item[1]}
+            for pid, item in zip(plan.ids[:limit], items[:limit]) if item is not None
+        ]
     return jsonify({
-        "bot_ready": bot_ready,
-        "panels": panels,
-        "current_drop_slot": current_drop_slot,
-        "countdown": 605, # This is a placeholder
-        "is_kd_loop_enabled": is_kd_loop_enabled
+        "version": plan.version,
+        "panels": len(plan.ids),
+        "ready": {slot_key: sum(item is not None for item in items) for slot_key, items in zip(SLOT_KEYS, plan.slots)},
+        "wheel_position": kd_wheel.position,
+        "busiest_tick": max((len(b) for b in plan.buckets), default=0),
+        "slots": slots,
     })
-    
+
+@app.route("/api/workers")
+def workers():
+    """Trạng thái từng tiến trình worker (chế độ KD_WORKERS)."""
+    return jsonify(worker_supervisor.statuses() if worker_supervisor is not None else [])
+
+@app.route("/events")
+def events():
+    """Luồng SSE: gửi snapshot lúc kết nối, sau đó chỉ đẩy các thay đổi."""
+    q = event_broker.subscribe()
+    snapshot = {"status": status_payload(), "panels": [public_panel(p) for p in panel_state.panels]}
+
+    def stream():
+        try:
+            yield f"event: snapshot\ndata: {json.dumps(snapshot, ensure_ascii=False)}\n\n"
+            while not q.dropped:
+                try:
+                    yield q.get(timeout=SSE_HEARTBEAT)
+                except queue.Empty:
+                    yield ": ping\n\n"
+        finally:
+            event_broker.unsubscribe(q)
+
+    return Response(stream(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+HEALTH_MAX_STALL = float(os.getenv("HEALTH_MAX_STALL_SECONDS", "5")) # Loop không phản hồi lâu hơn: không sống
+HEALTH_MAX_LAG = float(os.getenv("HEALTH_MAX_LAG_SECONDS", "0.5")) # p99 độ trễ loop lớn hơn: chưa sẵn sàng
+SENDER_STALE_SECONDS = float(os.getenv("SENDER_STALE_SECONDS", "30")) # Vòng gửi trễ lịch lâu hơn: coi như treo
+
+def check_sender():
+    """Vòng gửi 'kd' (hoặc vòng giám sát worker) còn chạy và không trễ lịch quá SENDER_STALE_SECONDS."""
+    task = sender_task
+    if task is None:
+        return {"ok": False, "reason": "chưa khởi động"}
+    if task.done():
+        error = task.exception() if not task.cancelled() else None
+        return {"ok": False, "reason": f"đã dừng: {error!r}" if error else "đã dừng"}
+    heartbeat_age = round(time.monotonic() - sender_heartbeat, 3) if sender_heartbeat is not None else None
+    if worker_supervisor is not None:
+        alive = sum(1 for row in worker_supervisor.statuses() if row["alive"])
+        ok = heartbeat_age is None or heartbeat_age < SENDER_STALE_SECONDS
+        return {"ok": ok and alive == KD_WORKERS, "heartbeat_age": heartbeat_age, "workers_alive": alive}
+    # Vòng gửi còn sống thì mốc kế tiếp không bao giờ bị bỏ lỡ lâu; đang tạm dừng hay chờ bot thì không có mốc
+    overdue = None
+    if kd_scheduler.next_deadline is not None and kd_scheduler.paused_remaining is None:
+        overdue = round(max(0.0, time.monotonic() - kd_scheduler.next_deadline), 3)
+    return {"ok": overdue is None or overdue < SENDER_STALE_SECONDS, "heartbeat_age": heartbeat_age,
+            "overdue": overdue, "paused": not is_kd_loop_enabled}
+
+def check_gateway():
+    if listener_pool is None:
+        return {"ok": False, "reason": "chưa khởi động"}
+    connected = sum(1 for shard in listener_pool.shards if shard.connected)
+    return {"ok": connected > 0, "connected": connected, "shards": len(listener_pool.shards)}
+
+def health_checks(ready):
+    """Kết quả từng kiểm tra; ready=True thêm các điều kiện để nhận tải (gateway, độ trễ loop, bot sẵn sàng)."""
+    stalled = loop_monitor.stalled_for()
+    checks = {
+        "event_loop": {"ok": loop_monitor.last_beat is not None and stalled < HEALTH_MAX_STALL,
+                       "stalled_for": round(stalled, 3)},
+        "sender": check_sender(),
+    }
+    if ready:
+        lag = loop_monitor.lag.summary()
+        checks["loop_lag"] = {"ok": lag.get("p99", 0.0) <= HEALTH_MAX_LAG, **lag}
+        checks["gateway"] = check_gateway()
+        checks["bot_ready"] = {"ok": bot_ready}
+    return checks
+
+def health_response(ready):
+    checks = health_checks(ready)
+    ok = all(check["ok"] for check in checks.values())
+    return jsonify({"ok": ok, "checks": checks}), 200 if ok else 503
+
+@app.route("/healthz")
+def healthz():
+    """Sống: event loop còn phản hồi và vòng gửi 'kd' không treo. Lỗi thì nên khởi động lại tiến trình."""
+    return health_response(ready=False)
+
+@app.route("/readyz")
+def readyz():
+    """Sẵn sàng: như /healthz, thêm gateway đã kết nối, bot sẵn sàng và p99 độ trễ loop dưới ngưỡng."""
+    return health_response(ready=True)
+
 @app.route("/api/toggle_kd", methods=['POST'])
 def toggle_kd():
     global is_kd_loop_enabled
     is_kd_loop_enabled = not is_kd_loop_enabled
+    if worker_supervisor is not None:
+        worker_supervisor.broadcast("kd_enabled", is_kd_loop_enabled)
+    if main_loop is not None:
+        main_loop.call_soon_threadsafe(kd_scheduler.set_enabled, is_kd_loop_enabled)
+        main_loop.call_soon_threadsafe(publish_status)
     state = "BẬT" if is_kd_loop_enabled else "TẮT"
     return jsonify({"message": f"Vòng lặp gửi 'kd' đã được {state}.", "is_enabled": is_kd_loop_enabled})
 
 # --- HÀM KHỞI CHẠY CHÍNH ---
-# Add a global variable for the last cycle time
-last_kd_cycle_time = 0
 
 async def main():
-    global last_kd_cycle_time
+    global main_loop, worker_supervisor, sender_task
+    setup_logging()
+    main_loop = asyncio.get_running_loop()
     if not TOKENS_STR:
-        print("Lỗi: Biến môi trường TOKENS chưa được thiết lập. Vui lòng thêm token vào file .env.")
+        log.error("Lỗi: Biến môi trường TOKENS chưa được thiết lập. Vui lòng thêm token vào file .env.")
         return
 
     load_panels()
-    
-    last_kd_cycle_time = time.time() # Initialize timer on start
+    if KD_WORKERS > 0:
+        if panel_store.name != "sqlite":
+            log.warning("Chế độ KD_WORKERS cần PANEL_STORE=sqlite để các worker dùng chung cấu hình. Chạy một tiến trình.")
+        else:
+            worker_supervisor = WorkerSupervisor(KD_WORKERS)
+            worker_supervisor.start()
 
     def run_flask():
         from waitress import serve
         port = int(os.environ.get("PORT", 10000))
-        print(f"Khởi động Web Server tại http://0.0.0.0:{port}")
-        serve(app, host="0.0.0.0", port=port)
+        log.info("Khởi động Web Server tại http://0.0.0.0:%d", port)
+        # Mỗi tab dashboard giữ một luồng cho kết nối SSE nên cần nhiều luồng hơn mặc định (4)
+        serve(app, host="0.0.0.0", port=port, threads=int(os.environ.get("WEB_THREADS", 16)))
     
     flask_thread = threading.Thread(target=run_flask, daemon=True)
     flask_thread.start()
     
-    # We need to modify the drop_sender_loop to update the global time
-    async def updated_drop_sender_loop():
-        global current_drop_slot, last_kd_cycle_time
-        print("Vòng lặp gửi 'kd' đang chờ bot sẵn sàng...")
-        while not bot_ready:
-            await asyncio.sleep(1)
-        print("Bot đã sẵn sàng. Bắt đầu vòng lặp gửi 'kd'.")
-    
-        while True:
-            if not is_kd_loop_enabled:
-                await asyncio.sleep(5)
-                # When paused, we should also pause the countdown timer
-                last_kd_cycle_time = time.time()
-                continue
-            
-            try:
-                slot_key = f"slot_{current_drop_slot + 1}"
-                print(f"\n--- Đang trong lượt của Slot {current_drop_slot + 1} ---")
-    
-                tasks = []
-                active_sends = 0
-                for panel in panels:
-                    channel_id = panel.get("channel_id")
-                    token_to_use = panel.get("accounts", {}).get(slot_key)
-    
-                    if token_to_use and channel_id:
-                        task = asyncio.to_thread(send_message_http, token_to_use, channel_id, "kd")
-                        tasks.append(task)
-                        active_sends +=1
-                    
-                if tasks:
-                    print(f"Gửi đồng thời {active_sends} lệnh 'kd' cho các tài khoản ở {slot_key}...")
-                    await asyncio.gather(*tasks)
-                else:
-                    print(f"Không có tài khoản nào được cấu hình cho {slot_key} trong bất kỳ panel nào.")
-    
-                current_drop_slot = (current_drop_slot + 1) % 3
-    
-                print(f"Đã xong lượt. Chờ 605 giây cho lượt kế tiếp (Slot {current_drop_slot + 1})...")
-                last_kd_cycle_time = time.time() # Reset timer after sending
-                await asyncio.sleep(605)
-    
-            except Exception as e:
-                print(f"[DROP SENDER ERROR] Lỗi nghiêm trọng trong vòng lặp gửi 'kd': {e}")
-                await asyncio.sleep(60)
-
-    # And the status endpoint needs to calculate the remaining time
-    @app.route("/status")
-    def updated_status():
-        remaining_time = 0
-        if is_kd_loop_enabled:
-            elapsed = time.time() - last_kd_cycle_time
-            remaining_time = max(0, 605 - elapsed)
-
-        return jsonify({
-            "bot_ready": bot_ready,
-            "panels": panels,
-            "current_drop_slot": current_drop_slot,
-            "countdown": remaining_time,
-            "is_kd_loop_enabled": is_kd_loop_enabled
-        })
-    
-    # We have to replace the old status route
-    app.view_functions['status'] = updated_status
-
-    sender_task = asyncio.create_task(updated_drop_sender_loop(), name='drop_sender_loop')
+    if worker_supervisor is not None:
+        sender_task = asyncio.create_task(worker_supervisor.monitor(), name='worker_supervisor')
+    else:
+        sender_task = asyncio.create_task(drop_sender_loop(), name='drop_sender_loop')
     listener_task = asyncio.create_task(run_listener_bot(), name='listener_bot')
+    backfill_task = asyncio.create_task(backfill_guild_ids(), name='backfill_guild_ids')
+    monitor_task = asyncio.create_task(loop_monitor.run(), name='loop_monitor')
 
-    await asyncio.gather(sender_task, listener_task)
+    try:
+        await asyncio.gather(sender_task, listener_task)
+    finally:
+        monitor_task.cancel()
+        if worker_supervisor is not None:
+            worker_supervisor.stop()
+        await close_session()
+        panel_writer.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,297 @@
+# Lớp lưu trữ cấu hình panel, có thể thay backend.
+# - SQLitePanelStore: file SQLite cục bộ ở chế độ WAL, mỗi panel là một dòng nên sửa 1 panel chỉ ghi 1 dòng.
+# - JsonBinPanelStore: backend cũ trên JSONBin.io, mỗi lần lưu là tải lên toàn bộ danh sách.
+import os
+import json
+import sqlite3
+import time
+import logging
+import threading
+import requests
+
+log = logging.getLogger(__name__)
+
+
+class SQLitePanelStore:
+    """Lưu panels trong SQLite (WAL), cập nhật theo từng dòng."""
+    name = "sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS panels ("
+            " id TEXT PRIMARY KEY,"
+            " position INTEGER NOT NULL,"
+            " data TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        # Trạng thái các tiến trình worker (chế độ KD_WORKERS), mỗi worker tự ghi dòng của mình
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS worker_status ("
+            " worker_id INTEGER PRIMARY KEY,"
+            " pid INTEGER NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " data TEXT NOT NULL)"
+        )
+
+    def _stored_version(self, cur):
+        row = cur.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def load(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM panels ORDER BY position").fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def version(self):
+        with self._lock:
+            return self._stored_version(self._conn.cursor())
+
+    def write(self, panels, upserted=(), deleted=(), version=None):
+        """Ghi các panel đã đổi và xóa các panel đã bị xóa trong một transaction.
+
+        Nếu không truyền upserted/deleted thì ghi đè toàn bộ bằng danh sách panels.
+        Bản có version nhỏ hơn hoặc bằng version đã lưu sẽ bị bỏ qua. Trả về True nếu đã ghi.
+        """
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                if version is not None:
+                    if version <= self._stored_version(cur):
+                        cur.execute("ROLLBACK")
+                        return False
+                    cur.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (str(version),))
+                if not upserted and not deleted:
+                    cur.execute("DELETE FROM panels")
+                    cur.executemany(
+                        "INSERT INTO panels (id, position, data) VALUES (?, ?, ?)",
+                        [(p["id"], i, json.dumps(p, ensure_ascii=False)) for i, p in enumerate(panels)],
+                    )
+                else:
+                    cur.executemany("DELETE FROM panels WHERE id = ?", [(pid,) for pid in deleted])
+                    cur.executemany(
+                        "INSERT INTO panels (id, position, data)"
+                        " VALUES (?, (SELECT COALESCE(MAX(position), -1) + 1 FROM panels), ?)"
+                        " ON CONFLICT(id) DO UPDATE SET data = excluded.data",
+                        [(p["id"], json.dumps(p, ensure_ascii=False)) for p in upserted],
+                    )
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+        return True
+
+    def write_worker_status(self, worker_id, pid, data):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO worker_status (worker_id, pid, updated_at, data) VALUES (?, ?, ?, ?)",
+                (worker_id, pid, time.time(), json.dumps(data, ensure_ascii=False)),
+            )
+
+    def read_worker_status(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT worker_id, pid, updated_at, data FROM worker_status ORDER BY worker_id").fetchall()
+        return [{"worker_id": wid, "pid": pid, "updated_at": updated_at, **json.loads(data)}
+                for wid, pid, updated_at, data in rows]
+
+    def clear_worker_status(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM worker_status")
+
+    def is_empty(self):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM panels LIMIT 1").fetchone() is None
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class JsonBinPanelStore:
+    """Lưu toàn bộ danh sách panels lên JSONBin.io (backend tùy chọn)."""
+    name = "jsonbin"
+
+    def __init__(self, api_key, bin_id):
+        self.api_key = api_key
+        self.bin_id = bin_id
+        self._version = 0 # JSONBin chỉ chứa danh sách panels nên version chỉ giữ trong bộ nhớ
+
+    def version(self):
+        return self._version
+
+    def load(self):
+        headers = {'X-Master-Key': self.api_key, 'X-Bin-Meta': 'false'}
+        url = f"https://api.jsonbin.io/v3/b/{self.bin_id}/latest"
+        try:
+            req = requests.get(url, headers=headers, timeout=15)
+            if req.status_code == 200:
+                data = req.json()
+                if isinstance(data, list):
+                    log.info("[Settings] Đã tải %d panel từ JSONBin.io.", len(data), extra={"count": len(data)})
+                    return data
+                try:
+                    self.write([])
+                except Exception as e:
+                    log.warning("[Settings] %s", e)
+            else:
+                log.error("[Settings] Lỗi khi tải cài đặt: %s", req.text, extra={"status": req.status_code})
+        except Exception as e:
+            log.error("[Settings] Exception khi tải cài đặt", extra={"error": repr(e)})
+        return []
+
+    def write(self, panels, upserted=(), deleted=(), version=None):
+        """JSONBin không hỗ trợ cập nhật từng phần nên luôn tải lên cả danh sách (chạy đồng bộ)."""
+        if version is not None and version <= self._version:
+            return False
+        headers = {'Content-Type': 'application/json', 'X-Master-Key': self.api_key}
+        url = f"https://api.jsonbin.io/v3/b/{self.bin_id}"
+        req = requests.put(url, json=list(panels), headers=headers, timeout=15)
+        if req.status_code == 200:
+            log.info("[Settings] Đã lưu cấu hình panels lên JSONBin.io thành công.")
+        else:
+            raise RuntimeError(f"Lỗi khi lưu cài đặt: {req.status_code} - {req.text}")
+        if version is not None:
+            self._version = version
+        return True
+
+    def close(self):
+        pass
+
+
+class DebouncedWriter:
+    """Luồng ghi nền duy nhất: gom các thay đổi liên tiếp và ghi một lần sau một khoảng lặng.
+
+    Mỗi lần mark() tăng version; luồng ghi luôn chụp trạng thái mới nhất nên một bản cũ
+    không thể ghi đè bản mới hơn. close() ghi nốt phần còn lại trước khi tắt.
+    """
+
+    def __init__(self, store, snapshot, quiet=1.0, max_delay=5.0):
+        self.store = store
+        self.snapshot = snapshot # Hàm trả về bản sao danh sách panels hiện tại
+        self.quiet = quiet
+        self.max_delay = max_delay
+        self.version = store.version()
+        self.persisted_version = self.version
+        self._upserted = set()
+        self._deleted = set()
+        self._full = False
+        self._first_dirty = None
+        self._last_dirty = None
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="panel-writer", daemon=True)
+        self._thread.start()
+
+    def mark(self, upserted=(), deleted=()):
+        """Đánh dấu các panel cần ghi. Không truyền gì nghĩa là ghi lại toàn bộ. Trả về version mới."""
+        with self._cond:
+            self.version += 1
+            if not upserted and not deleted:
+                self._full = True
+            for pid in upserted:
+                self._upserted.add(pid)
+                self._deleted.discard(pid)
+            for pid in deleted:
+                self._deleted.add(pid)
+                self._upserted.discard(pid)
+            now = time.monotonic()
+            if self._first_dirty is None:
+                self._first_dirty = now
+            self._last_dirty = now
+            self._cond.notify()
+            return self.version
+
+    def _take(self):
+        """Lấy ra tập thay đổi đang chờ. Gọi khi đang giữ self._cond."""
+        pending = (self.version, self._full, self._upserted, self._deleted)
+        self._upserted, self._deleted, self._full = set(), set(), False
+        self._first_dirty = self._last_dirty = None
+        return pending
+
+    def _write(self, pending):
+        version, full, upserted, deleted = pending
+        with self._write_lock:
+            if version <= self.persisted_version:
+                return True
+            panels = self.snapshot()
+            rows = [] if full else [p for p in panels if p.get("id") in upserted]
+            try:
+                self.store.write(panels, upserted=rows, deleted=[] if full else list(deleted), version=version)
+                self.persisted_version = version
+                return True
+            except Exception as e:
+                log.error("[Settings] Exception khi lưu cài đặt", extra={"error": repr(e)})
+            # Ghi lỗi: trả thay đổi về hàng chờ để lần sau thử lại
+            with self._cond:
+                self._full = self._full or full
+                self._upserted |= upserted - self._deleted
+                self._deleted |= deleted - self._upserted
+                if self._first_dirty is None:
+                    self._first_dirty = self._last_dirty = time.monotonic()
+            return False
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # Chờ có thay đổi rồi chờ hết khoảng lặng, nhưng không dồn lâu hơn max_delay
+                while not self._closed:
+                    if self._first_dirty is None: # Chưa có gì hoặc flush() vừa lấy mất
+                        self._cond.wait()
+                        continue
+                    deadline = min(self._last_dirty + self.quiet, self._first_dirty + self.max_delay)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._closed:
+                    return
+                pending = self._take()
+            if not self._write(pending):
+                time.sleep(self.max_delay)
+
+    def flush(self):
+        """Ghi ngay mọi thay đổi đang chờ (đồng bộ)."""
+        with self._cond:
+            if self._first_dirty is None:
+                return
+            pending = self._take()
+        self._write(pending)
+
+    def close(self):
+        """Dừng luồng ghi và ghi nốt các thay đổi còn lại."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout=5)
+        self.flush()
+        self.store.close()
+
+
+def create_panel_store():
+    """Chọn backend theo biến môi trường PANEL_STORE (sqlite | jsonbin), mặc định là sqlite."""
+    backend = os.getenv("PANEL_STORE", "sqlite").strip().lower()
+    api_key = os.getenv("JSONBIN_API_KEY")
+    bin_id = os.getenv("JSONBIN_BIN_ID")
+
+    if backend == "jsonbin":
+        if not api_key or not bin_id:
+            log.warning("[Settings] Thiếu API Key hoặc Bin ID của JSONBin. Chuyển sang lưu bằng SQLite.")
+        else:
+            return JsonBinPanelStore(api_key, bin_id)
+
+    store = SQLitePanelStore(os.getenv("PANEL_DB_PATH", "panels.db"))
+    # Lần đầu chuyển sang SQLite: kéo cấu hình cũ từ JSONBin về nếu có
+    if store.is_empty() and api_key and bin_id:
+        old_panels = JsonBinPanelStore(api_key, bin_id).load()
+        if old_panels:
+            store.write(old_panels)
+            log.info("[Settings] Đã chuyển %d panel từ JSONBin.io sang SQLite.", len(old_panels), extra={"count": len(old_panels)})
+    return store
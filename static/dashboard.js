@@ -0,0 +1,353 @@
+document.addEventListener('DOMContentLoaded', function () {
+    const API_ENDPOINT = '/api/panels';
+    let GLOBAL_ACCOUNTS = []; // [{id, name}] tải từ /api/accounts, không chứa token
+    let ACCOUNT_NAMES = new Map();
+    const SLOT_KEYS = ['slot_1', 'slot_2', 'slot_3'];
+    const PLACEHOLDER = '-- Chọn tài khoản --';
+
+    // Trạng thái phía client, được cập nhật bằng các sự kiện SSE từ /events
+    const panelMap = new Map(); // id -> panel, theo đúng thứ tự của server
+    const panelEls = new Map(); // id -> phần tử DOM, chỉ giữ các panel của trang đang xem
+    const usedAccounts = new Map(); // id tài khoản -> số slot đang dùng tài khoản đó
+    let filteredIds = []; // id các panel khớp bộ lọc
+    let currentPage = 0;
+    let statusState = null;
+    let clockOffset = 0; // Chênh lệch giữa đồng hồ server và trình duyệt (giây)
+
+    const grid = document.getElementById('farm-grid');
+    const searchInput = document.getElementById('panel-search');
+    const filterSelect = document.getElementById('panel-filter');
+    const pageSizeSelect = document.getElementById('page-size');
+
+    async function apiCall(method, data = null) {
+        try {
+            const options = {
+                method: method,
+                headers: { 'Content-Type': 'application/json' },
+            };
+            if (data) options.body = JSON.stringify(data);
+            const response = await fetch(API_ENDPOINT, options);
+            if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
+            return await response.json();
+        } catch (error) {
+            console.error('API call failed:', error);
+            alert('Thao tác thất bại. Vui lòng kiểm tra console log.');
+            return null;
+        }
+    }
+
+    function countAccounts(panel, delta) {
+        SLOT_KEYS.forEach(slot => {
+            const accId = panel.accounts[slot];
+            if (!accId) return;
+            const count = (usedAccounts.get(accId) || 0) + delta;
+            if (count > 0) usedAccounts.set(accId, count); else usedAccounts.delete(accId);
+        });
+    }
+
+    function matchesFilter(panel) {
+        const query = searchInput.value.trim().toLowerCase();
+        if (query) {
+            const text = `${panel.name} ${panel.channel_id || ''} ${panel.server_name || ''}`.toLowerCase();
+            if (!text.includes(query)) return false;
+        }
+        switch (filterSelect.value) {
+            case 'no-channel': return !panel.channel_id;
+            case 'missing-accounts': return SLOT_KEYS.some(slot => !panel.accounts[slot]);
+            case 'ready': return !!panel.channel_id && SLOT_KEYS.every(slot => panel.accounts[slot]);
+            default: return true;
+        }
+    }
+
+    // Select chỉ chứa option đang chọn; danh sách đầy đủ được dựng khi người dùng mở nó
+    function collapseSelect(select, accId) {
+        const options = [new Option(PLACEHOLDER, '')];
+        if (accId) options.push(new Option(ACCOUNT_NAMES.get(accId) || accId, accId));
+        select.replaceChildren(...options);
+        select.value = accId;
+        select.dataset.expanded = '';
+    }
+
+    function expandSelect(select) {
+        if (select.dataset.expanded === '1') return;
+        const current = select.value;
+        const options = [new Option(PLACEHOLDER, '')];
+        GLOBAL_ACCOUNTS.forEach(acc => {
+            if (!usedAccounts.has(acc.id) || acc.id === current) options.push(new Option(acc.name, acc.id));
+        });
+        select.replaceChildren(...options);
+        select.value = current;
+        select.dataset.expanded = '1';
+    }
+
+    function createPanelEl(panel) {
+        const panelEl = document.createElement('div');
+        panelEl.className = 'panel';
+        panelEl.dataset.id = panel.id;
+        panelEl.innerHTML = `
+            <div class="panel-header">
+                <h3 contenteditable="true" class="panel-name"></h3>
+                <button class="btn btn-danger btn-sm delete-panel-btn"><i class="fas fa-trash"></i></button>
+            </div>
+            <div class="input-group">
+                <label>Channel ID</label>
+                <input type="text" class="channel-id-input">
+                <small class="server-name-display"></small>
+            </div>
+            <div class="account-slots">${SLOT_KEYS.map((slot, i) => `
+                <div class="input-group">
+                    <label>Slot ${i + 1}</label>
+                    <select class="account-selector" data-slot="${slot}"></select>
+                </div>`).join('')}
+            </div>
+        `;
+        panelEl.refs = {
+            name: panelEl.querySelector('.panel-name'),
+            channel: panelEl.querySelector('.channel-id-input'),
+            server: panelEl.querySelector('.server-name-display'),
+            selects: Object.fromEntries(SLOT_KEYS.map(slot => [slot, panelEl.querySelector(`select[data-slot="${slot}"]`)])),
+        };
+        panelEl.panel = null;
+        updatePanelEl(panelEl, panel);
+        return panelEl;
+    }
+
+    // Chỉ chạm vào các trường thực sự thay đổi, bỏ qua ô người dùng đang sửa
+    function updatePanelEl(panelEl, panel) {
+        const prev = panelEl.panel;
+        const refs = panelEl.refs;
+        if ((!prev || prev.name !== panel.name) && document.activeElement !== refs.name) {
+            refs.name.textContent = panel.name;
+        }
+        if ((!prev || prev.channel_id !== panel.channel_id) && document.activeElement !== refs.channel) {
+            refs.channel.value = panel.channel_id || '';
+        }
+        if (!prev || prev.server_name !== panel.server_name) {
+            refs.server.textContent = panel.server_name || '(Tên server sẽ hiện ở đây)';
+        }
+        SLOT_KEYS.forEach(slot => {
+            const accId = panel.accounts[slot] || '';
+            if (prev && (prev.accounts[slot] || '') === accId) return;
+            const select = refs.selects[slot];
+            if (select.dataset.expanded === '1') select.value = accId; else collapseSelect(select, accId);
+        });
+        panelEl.panel = panel;
+    }
+
+    function refilter() {
+        filteredIds = [];
+        panelMap.forEach(panel => { if (matchesFilter(panel)) filteredIds.push(panel.id); });
+        renderGrid();
+    }
+
+    // Đối chiếu theo id: giữ nguyên phần tử đã có, chỉ tạo / gỡ / dời những panel thay đổi trên trang
+    function renderGrid() {
+        const size = parseInt(pageSizeSelect.value, 10);
+        const pages = Math.max(1, Math.ceil(filteredIds.length / size));
+        currentPage = Math.min(currentPage, pages - 1);
+        const start = currentPage * size;
+        const pageIds = filteredIds.slice(start, start + size);
+
+        const visible = new Set(pageIds);
+        panelEls.forEach((el, id) => {
+            if (!visible.has(id)) { el.remove(); panelEls.delete(id); }
+        });
+        let cursor = grid.firstElementChild;
+        pageIds.forEach(id => {
+            let el = panelEls.get(id);
+            if (!el) {
+                el = createPanelEl(panelMap.get(id));
+                panelEls.set(id, el);
+            }
+            if (el === cursor) cursor = cursor.nextElementSibling;
+            else grid.insertBefore(el, cursor);
+        });
+
+        document.getElementById('page-info').textContent = filteredIds.length
+            ? `${start + 1}–${start + pageIds.length} / ${filteredIds.length} panel (trang ${currentPage + 1}/${pages})`
+            : 'Không có panel nào';
+        document.getElementById('prev-page').disabled = currentPage === 0;
+        document.getElementById('next-page').disabled = currentPage >= pages - 1;
+    }
+
+    function renderStatus() {
+        const data = statusState;
+        if (!data) return;
+        document.getElementById('bot-status').textContent = data.bot_ready ? 'Đang hoạt động' : 'Đang kết nối...';
+        document.getElementById('total-panels').textContent = panelMap.size;
+        document.getElementById('next-slot').textContent = `Slot ${data.current_drop_slot + 1}`;
+
+        const toggleBtn = document.getElementById('toggle-kd-btn');
+        if (toggleBtn) {
+            if (data.is_kd_loop_enabled) {
+                toggleBtn.textContent = 'TẮT VÒNG LẶP KD';
+                toggleBtn.classList.remove('btn-danger');
+                document.getElementById('next-slot').style.color = 'var(--accent-color)';
+            } else {
+                toggleBtn.textContent = 'BẬT VÒNG LẶP KD';
+                toggleBtn.classList.add('btn-danger');
+                document.getElementById('next-slot').style.color = 'var(--danger-color)';
+            }
+        }
+        tickCountdown();
+    }
+
+    // Đếm ngược tính tại chỗ từ mốc next_fire_at do server gửi, không cần gọi server
+    function tickCountdown() {
+        let countdown = 0;
+        if (statusState && statusState.next_fire_at) {
+            const serverNow = Date.now() / 1000 + clockOffset;
+            countdown = Math.max(0, statusState.next_fire_at - serverNow);
+        } else if (statusState && statusState.seconds_until_next) {
+            countdown = statusState.seconds_until_next; // Đang tạm dừng: giữ nguyên thời gian còn lại
+        }
+        let timeString = new Date(countdown * 1000).toISOString().substr(11, 8);
+        document.getElementById('countdown').textContent = timeString;
+    }
+
+    function applyStatus(data) {
+        statusState = data;
+        clockOffset = data.server_time - Date.now() / 1000;
+        renderStatus();
+    }
+
+    function upsertPanel(panel) {
+        const prev = panelMap.get(panel.id);
+        if (prev) countAccounts(prev, -1);
+        countAccounts(panel, 1);
+        panelMap.set(panel.id, panel);
+        const el = panelEls.get(panel.id);
+        if (prev && matchesFilter(prev) === matchesFilter(panel)) {
+            if (el) updatePanelEl(el, panel); // Sửa một panel chỉ chạm vào đúng panel đó
+        } else {
+            refilter();
+        }
+        renderStatus();
+    }
+
+    function loadSnapshot(panels) {
+        panelMap.clear();
+        usedAccounts.clear();
+        panels.forEach(panel => {
+            panelMap.set(panel.id, panel);
+            countAccounts(panel, 1);
+        });
+        panelEls.forEach((el, id) => { if (panelMap.has(id)) updatePanelEl(el, panelMap.get(id)); });
+        refilter();
+    }
+
+    function connectEvents() {
+        const source = new EventSource('/events');
+        source.addEventListener('snapshot', e => {
+            const data = JSON.parse(e.data);
+            loadSnapshot(data.panels);
+            applyStatus(data.status);
+        });
+        source.addEventListener('status', e => applyStatus(JSON.parse(e.data)));
+        source.addEventListener('panel', e => upsertPanel(JSON.parse(e.data)));
+        source.addEventListener('panel_deleted', e => {
+            const { id } = JSON.parse(e.data);
+            const prev = panelMap.get(id);
+            if (!prev) return;
+            countAccounts(prev, -1);
+            panelMap.delete(id);
+            refilter();
+            renderStatus();
+        });
+        // EventSource tự kết nối lại khi mất kết nối và nhận lại snapshot
+        source.onerror = () => { document.getElementById('bot-status').textContent = 'Mất kết nối...'; };
+    }
+
+    let searchTimer = null;
+    searchInput.addEventListener('input', () => {
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(() => { currentPage = 0; refilter(); }, 150);
+    });
+    filterSelect.addEventListener('change', () => { currentPage = 0; refilter(); });
+    pageSizeSelect.addEventListener('change', () => { currentPage = 0; renderGrid(); });
+    document.getElementById('prev-page').addEventListener('click', () => { currentPage--; renderGrid(); });
+    document.getElementById('next-page').addEventListener('click', () => { currentPage++; renderGrid(); });
+
+    document.getElementById('add-panel-btn').addEventListener('click', async () => {
+        const name = prompt('Nhập tên cho panel mới:', 'Farm Server Mới');
+        if (name) {
+            await apiCall('POST', { name });
+        }
+    });
+
+    grid.addEventListener('click', async (e) => {
+        if (e.target.closest('.delete-panel-btn')) {
+            const panelEl = e.target.closest('.panel');
+            const panelId = panelEl.dataset.id;
+            if (confirm(`Bạn có chắc muốn xóa panel "${panelEl.querySelector('.panel-name').textContent}"?`)) {
+                await apiCall('DELETE', { id: panelId });
+            }
+        }
+    });
+
+    // Dựng danh sách tài khoản khi select được mở, thu gọn lại khi rời khỏi
+    const onSelectOpen = (e) => {
+        if (e.target.classList.contains('account-selector')) expandSelect(e.target);
+    };
+    grid.addEventListener('mousedown', onSelectOpen);
+    grid.addEventListener('focusin', onSelectOpen);
+    grid.addEventListener('focusout', (e) => {
+        if (e.target.classList.contains('account-selector')) collapseSelect(e.target, e.target.value);
+    });
+
+    grid.addEventListener('change', async (e) => {
+        const panelEl = e.target.closest('.panel');
+        if (!panelEl) return;
+        const panelId = panelEl.dataset.id;
+
+        const payload = { id: panelId, update: {} };
+
+        if (e.target.classList.contains('channel-id-input')) {
+            payload.update.channel_id = e.target.value.trim();
+
+            // Gửi API call để LƯU và LẤY tên server
+            const updatedPanel = await apiCall('PUT', payload);
+
+            // Cập nhật tên server ngay lập tức
+            if (updatedPanel) {
+                panelEl.refs.server.textContent = updatedPanel.server_name || '(Không tìm thấy server)';
+            }
+        } else if (e.target.classList.contains('account-selector')) {
+            const slot = e.target.dataset.slot;
+            const accountId = e.target.value;
+            payload.update.accounts = { [slot]: accountId };
+
+            // Gửi API call để LƯU lựa chọn mới; server sẽ đẩy sự kiện 'panel' để cập nhật đúng panel này
+            await apiCall('PUT', payload);
+        }
+    });
+
+    grid.addEventListener('blur', async (e) => {
+        if (e.target.classList.contains('panel-name')) {
+             const panelEl = e.target.closest('.panel');
+             const newName = e.target.textContent.trim();
+             if (panelEl.panel && panelEl.panel.name === newName) return;
+             await apiCall('PUT', { id: panelEl.dataset.id, update: { name: newName } });
+        }
+    }, true);
+
+    const toggleBtn = document.getElementById('toggle-kd-btn');
+    if (toggleBtn) {
+        toggleBtn.addEventListener('click', async () => {
+            await fetch('/api/toggle_kd', { method: 'POST' });
+        });
+    }
+
+    async function loadAccounts() {
+        try {
+            const response = await fetch('/api/accounts');
+            GLOBAL_ACCOUNTS = await response.json();
+        } catch (error) {
+            console.error('Không tải được danh sách tài khoản:', error);
+        }
+        ACCOUNT_NAMES = new Map(GLOBAL_ACCOUNTS.map(acc => [acc.id, acc.name]));
+    }
+
+    setInterval(tickCountdown, 1000); // Chỉ cập nhật đồng hồ tại chỗ, không gọi server
+    loadAccounts().then(connectEvents);
+});
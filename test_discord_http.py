@@ -0,0 +1,93 @@
+# Kiểm tra bộ điều phối rate limit với máy chủ Discord giả (fake_discord.py): chờ bucket, thử lại khi 429
+# và không kẹt lock khi request bị hủy. Chạy: python -m pytest -q
+import asyncio
+import time
+
+from aiohttp import web
+
+import discord_http
+from discord_http import RateLimiter, close_session
+from fake_discord import FakeDiscordAPI
+
+ROUTE = "/channels/{channel_id}/messages"
+
+
+async def _with_fake_api(api, body):
+    """Chạy FakeDiscordAPI trên một cổng tự chọn, trỏ client vào đó rồi gọi body()."""
+    runner = web.AppRunner(api.make_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    original = discord_http.DISCORD_API
+    discord_http.DISCORD_API = f"http://127.0.0.1:{port}"
+    try:
+        return await body()
+    finally:
+        discord_http.DISCORD_API = original
+        await close_session()
+        await runner.cleanup()
+
+
+def test_waits_for_bucket_reset_instead_of_hitting_429():
+    api = FakeDiscordAPI(bucket_limit=2, bucket_window=0.3)
+    limiter = RateLimiter(max_retries=0)
+
+    async def body():
+        started = time.monotonic()
+        results = await asyncio.gather(*(limiter.request("POST", ROUTE, "token", json={"content": "kd"}, channel_id="1")
+                                         for _ in range(5)))
+        return results, time.monotonic() - started
+
+    results, elapsed = asyncio.run(_with_fake_api(api, body))
+    assert [status for status, _ in results] == [200] * 5
+    assert api.stats["rate_limited"] == 0
+    assert elapsed >= 0.5 # 5 request với giới hạn 2 mỗi 0.3s phải chờ ít nhất hai lần reset
+
+
+def test_retries_after_429_then_gives_up():
+    api = FakeDiscordAPI(rate_429=1.0, retry_after=0.05)
+    limiter = RateLimiter(max_retries=2)
+
+    async def body():
+        return await limiter.request("POST", ROUTE, "token", json={"content": "kd"}, channel_id="1")
+
+    hits_before = discord_http.RATELIMIT_HITS.value(method="POST", route=ROUTE, scope="bucket")
+    status, data = asyncio.run(_with_fake_api(api, body))
+    assert status == 429
+    assert api.stats["injected_429"] == 3 # Lần đầu + 2 lần thử lại
+    # Mọi lần 429 đều được đếm, kể cả lần cuối không thử lại nữa
+    assert discord_http.RATELIMIT_HITS.value(method="POST", route=ROUTE, scope="bucket") - hits_before == 3
+
+
+def test_cancelled_wait_releases_bucket_lock():
+    api = FakeDiscordAPI(bucket_limit=1, bucket_window=30)
+    limiter = RateLimiter(max_retries=0)
+
+    async def body():
+        assert (await limiter.request("POST", ROUTE, "token", channel_id="1"))[0] == 200
+        # Bucket đã hết lượt và còn lâu mới reset: request kế tiếp phải ngủ trong _acquire
+        waiting = asyncio.create_task(limiter.request("POST", ROUTE, "token", channel_id="1"))
+        await asyncio.sleep(0.05)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        return [bucket.lock.locked() for bucket in limiter._buckets.values()]
+
+    locked = asyncio.run(_with_fake_api(api, body))
+    assert locked and not any(locked)
+
+
+def test_last_attempt_429_still_blocks_following_requests():
+    api = FakeDiscordAPI(rate_429=1.0, retry_after=0.3)
+    limiter = RateLimiter(max_retries=0)
+
+    async def body():
+        first = await limiter.request("POST", ROUTE, "token", channel_id="1")
+        api.rate_429 = 0.0
+        started = time.monotonic()
+        second = await limiter.request("POST", ROUTE, "token", channel_id="1")
+        return first[0], second[0], time.monotonic() - started
+
+    first, second, waited = asyncio.run(_with_fake_api(api, body))
+    assert (first, second) == (429, 200)
+    assert waited >= 0.25 # Request sau phải chờ hết retry_after của lần 429 trước
@@ -0,0 +1,107 @@
+# Kiểm tra API panel của dashboard qua app.test_client(): lô thao tác nguyên tử và phân trang bằng cursor.
+# Dùng SQLite tạm cho mỗi test, không cần token thật hay kết nối Discord. Chạy: python -m pytest -q
+import os
+
+os.environ.setdefault("TOKENS", "token-a,token-b")
+
+import pytest
+
+import multi_kd_v2 as bot
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setenv("PANEL_STORE", "sqlite")
+    monkeypatch.setenv("PANEL_DB_PATH", str(tmp_path / "panels.db"))
+    monkeypatch.delenv("JSONBIN_API_KEY", raising=False)
+    bot.publish_panels([])
+    bot.load_panels()
+    try:
+        yield bot.app.test_client()
+    finally:
+        bot.panel_writer.close()
+
+
+def _batch(client, *operations):
+    return client.post("/api/panels/batch", json={"operations": list(operations)})
+
+
+def _names(client):
+    return [panel["name"] for panel in client.get("/api/panels").get_json()]
+
+
+def test_batch_with_invalid_op_midway_changes_nothing(client):
+    assert _batch(client, {"op": "create", "name": "A", "id": "a"}).status_code == 200
+    version = bot.panel_state.version
+
+    res = _batch(client,
+                 {"op": "update", "id": "a", "update": {"name": "A2"}},
+                 {"op": "delete", "id": "khong-co"},
+                 {"op": "create", "name": "B"})
+    assert res.status_code == 400
+    assert [e["index"] for e in res.get_json()["errors"]] == [1]
+    assert bot.panel_state.version == version
+    assert _names(client) == ["A"]
+
+
+def test_batch_create_then_update_in_same_batch(client):
+    res = _batch(client,
+                 {"op": "create", "name": "A", "id": "moi"},
+                 {"op": "update", "id": "moi", "update": {"name": "A2", "accounts": {"slot_1": "acc_0"}}})
+    assert res.status_code == 200
+    assert [r["panel"]["name"] for r in res.get_json()["results"]] == ["A2", "A2"]
+    panel = bot.panel_state.by_id["moi"]
+    assert panel["name"] == "A2" and panel["accounts"]["slot_1"] == "token-a"
+    bot.panel_writer.flush()
+    assert [p["name"] for p in bot.panel_store.load()] == ["A2"]
+
+
+def test_batch_create_then_delete_in_same_batch(client):
+    _batch(client, {"op": "create", "name": "Cu", "id": "cu"})
+    res = _batch(client,
+                 {"op": "create", "name": "Tam", "id": "tam"},
+                 {"op": "delete", "id": "tam"},
+                 {"op": "delete", "id": "cu"})
+    assert res.status_code == 200
+    assert _names(client) == []
+    bot.panel_writer.flush()
+    assert bot.panel_store.load() == []
+
+
+def test_batch_create_rejects_duplicate_id(client):
+    _batch(client, {"op": "create", "name": "A", "id": "a"})
+    res = _batch(client, {"op": "create", "name": "B", "id": "a"})
+    assert res.status_code == 400
+    assert _names(client) == ["A"]
+
+
+def _pages(client, cursor=None, limit=4):
+    params = {"limit": limit}
+    if cursor:
+        params["cursor"] = cursor
+    data = client.get("/api/panels", query_string=params).get_json()
+    return [p["id"] for p in data["items"]], data["next_cursor"]
+
+
+def test_cursor_survives_deletes_and_inserts_between_pages(client):
+    _batch(client, *({"op": "create", "name": f"P{i}", "id": f"p{i}"} for i in range(10)))
+    first, cursor = _pages(client)
+    assert first == ["p0", "p1", "p2", "p3"]
+
+    # Xóa cả panel làm mốc của cursor lẫn panel đứng trước nó, rồi thêm panel mới
+    _batch(client, {"op": "delete", "id": "p1"}, {"op": "delete", "id": "p3"}, {"op": "delete", "id": "p5"},
+           {"op": "create", "name": "P10", "id": "p10"})
+    seen = []
+    while cursor:
+        ids, cursor = _pages(client, cursor)
+        seen.extend(ids)
+    assert seen == ["p4", "p6", "p7", "p8", "p9", "p10"]
+
+
+def test_cursor_keeps_position_when_anchor_survives(client):
+    _batch(client, *({"op": "create", "name": f"P{i}", "id": f"p{i}"} for i in range(8)))
+    _, cursor = _pages(client)
+    _batch(client, {"op": "delete", "id": "p0"}, {"op": "create", "name": "P8", "id": "p8"})
+    ids, cursor = _pages(client, cursor)
+    assert ids == ["p4", "p5", "p6", "p7"]
+    assert _pages(client, cursor)[0] == ["p8"]
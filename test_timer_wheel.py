@@ -0,0 +1,54 @@
+# Kiểm tra bánh xe hẹn giờ 'kd': slot đổi sau mỗi vòng và pha được rải đều giữa các ô. Chạy: python -m pytest -q
+import os
+
+os.environ.setdefault("TOKENS", "token-a,token-b")
+
+import pytest
+
+import multi_kd_v2 as bot
+from multi_kd_v2 import SLOT_KEYS, KdTimerWheel
+
+
+def _loads(wheel, panels):
+    loads = [0] * wheel.size
+    for p in panels:
+        loads[p["kd_offset"]] += 1
+    return loads
+
+
+def test_slot_rotates_each_round():
+    wheel = KdTimerWheel(5)
+    wheel.rebuild([{"id": "p", "name": "P", "kd_offset": 2}])
+    fired = []
+    for _ in range(4 * wheel.size):
+        plan, due, slot = wheel.take_due()
+        fired.extend((plan.ids[i], SLOT_KEYS[slot]) for i in due)
+    assert fired == [("p", "slot_1"), ("p", "slot_2"), ("p", "slot_3"), ("p", "slot_1")]
+
+
+def test_slot_follows_absolute_tick():
+    # Worker neo tick theo giờ thật: khởi động lại giữa chừng vẫn tiếp tục đúng slot của vòng hiện tại
+    wheel = KdTimerWheel(5)
+    wheel.rebuild([{"id": "p", "name": "P", "kd_offset": 0}])
+    wheel.tick = 7 * wheel.size
+    assert wheel.take_due()[2] == 7 % len(SLOT_KEYS)
+
+
+@pytest.mark.parametrize("count", [1, 604, 605, 1000, 1817])
+def test_assign_offsets_spreads_load_evenly(count):
+    wheel = KdTimerWheel(int(bot.KD_INTERVAL / bot.WHEEL_TICK))
+    panels = [{"id": f"p{i}"} for i in range(count)]
+    assert len(wheel.assign_offsets(panels)) == count
+    loads = _loads(wheel, panels)
+    average = count / wheel.size
+    assert average - 1 <= min(loads) and max(loads) <= average + 1
+
+
+def test_assign_offsets_keeps_balance_when_panels_are_added_in_batches():
+    wheel = KdTimerWheel(60)
+    panels = []
+    for batch in (7, 1, 45, 13, 120):
+        panels.extend({"id": f"p{len(panels) + i}"} for i in range(batch))
+        wheel.assign_offsets(panels) # Chỉ gán cho panel mới, panel cũ giữ nguyên pha
+        loads = _loads(wheel, panels)
+        assert max(loads) - min(loads) <= 1